@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+"""Stand-in for the APIC subscription API, lets the subscription feed run without a fabric
+
+    python apic_standin.py --port 8765
+
+Start the app with APIC_FEED_URL=http://127.0.0.1:8765 to point the feed at it. Every line typed (or piped) on stdin
+is one changed managed object as json and is pushed to each open websocket with the ids subscribed to its class:
+
+    {"fvCEp": {"attributes": {"dn": "uni/tn-T1/ap-AP1/epg-E1/cep-00:50:56:AA:BB:CC", "status": "deleted"}}}
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import struct
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+subscription_ids = itertools.count(1000)
+subscriptions = {}
+sockets = []
+lock = threading.Lock()
+
+
+def send_frame(connection, payload, opcode=0x1) -> None:
+    """Writes one unmasked websocket frame"""
+
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+    connection.sendall(header + payload)
+
+
+def read_frame(stream) -> tuple:
+    """Reads one masked client frame, returns opcode and payload"""
+
+    first, second = stream.read(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", stream.read(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", stream.read(8))
+
+    mask = stream.read(4) if second & 0x80 else b"\x00" * 4
+    payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(stream.read(length)))
+
+    return first & 0x0F, payload
+
+
+def push(mo) -> None:
+    """Sends a managed object to every websocket, tagged with the subscriptions of its class"""
+
+    class_name = next(iter(mo))
+    with lock:
+        ids = [str(sid) for sid, subscribed in subscriptions.items() if subscribed == class_name]
+        targets = list(sockets)
+
+    message = json.dumps({"subscriptionId": ids, "imdata": [mo]}).encode()
+    for connection in targets:
+        try:
+            send_frame(connection, message)
+        except OSError:
+            pass
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, body, status=200) -> None:
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+
+        uri = urlparse(self.path)
+        query = parse_qs(uri.query)
+
+        if uri.path.startswith("/socket") and self.headers.get("Upgrade", "").lower() == "websocket":
+            self.open_socket()
+        elif query.get("subscription") == ["yes"] and uri.path.startswith("/api/class/"):
+            class_name = uri.path.rsplit("/", 1)[1].split(".")[0]
+            subscription_id = next(subscription_ids)
+            with lock:
+                subscriptions[subscription_id] = class_name
+            self.send_json({"totalCount": "0", "subscriptionId": str(subscription_id), "imdata": []})
+        elif uri.path.startswith("/api/subscriptionRefresh"):
+            known = int(query.get("id", ["0"])[0]) in subscriptions
+            self.send_json({"totalCount": "0", "imdata": []}, status=200 if known else 400)
+        else:
+            self.send_json({"totalCount": "0", "imdata": []})
+
+    def open_socket(self) -> None:
+        """Completes the websocket handshake and answers pings until the client closes"""
+
+        accept = hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()).digest()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", base64.b64encode(accept).decode())
+        self.end_headers()
+
+        with lock:
+            sockets.append(self.connection)
+
+        try:
+            while True:
+                opcode, payload = read_frame(self.rfile)
+                if opcode == 0x8:
+                    send_frame(self.connection, payload[:2], opcode=0x8)
+                    break
+                if opcode == 0x9:
+                    send_frame(self.connection, payload, opcode=0xA)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with lock:
+                sockets.remove(self.connection)
+            self.close_connection = True
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="APIC subscription stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"APIC stand-in listening on http://{args.host}:{args.port}, managed objects are read from stdin")
+
+    for line in sys.stdin:
+        if line.strip():
+            try:
+                push(json.loads(line))
+            except (ValueError, StopIteration, AttributeError):
+                print(f"Not a managed object: {line.strip()}")
+
+    server.shutdown()
@@ -1,35 +1,60 @@
-import json
-import xml.etree.ElementTree as ET
 import collections
+import re
+from app.Modules.ApicQuery import run_concurrent, iter_json_pages, iter_class_attributes
 
+# Pages of a view query requested at once after the first
+PREFETCH_PAGES = 4
 
-def infr(session, apic):
-    """Takes in pod number , and return all information about the fabric hardware. Greate for TAC use"""
 
-    infra_info = collections.defaultdict(list)
+def pod_of(dn):
+    """Pod id from a topology dn, topology/pod-1/node-101 -> 1. None outside a pod"""
 
-    for i in range(1, 10):
-        uri = f"https://{apic}/api/node/mo/topology/pod-{i}.xml?query-target=children"
+    match = re.match(r"topology/pod-(\d+)", dn)
 
-        request = session.get(uri, verify=False)
-        if request.text.rfind("totalCount=\"0\"") != -1:
-            continue
-        else:
-            root = ET.fromstring(request.text)
+    return int(match.group(1)) if match else None
+
+
+def infr(session, apic):
+    """Return all information about the fabric hardware, grouped by pod. Greate for TAC use. Pods, nodes and health
+    scores are four class queries run at the same time, so the cost doesn't grow with the number of pods"""
+
+    class_uri = f"https://{apic}/api/class/{{}}.json?order-by={{}}.dn"
+    fabricPods, fabricNodes, fabricHealths, topSystems = run_concurrent(
+        *[(list, iter_json_pages(session, class_uri.format(name, name))) for name in
+          ("fabricPod", "fabricNode", "fabricHealthTotal")],
+        (list, iter_json_pages(session, class_uri.format("topSystem", "topSystem") + "&rsp-subtree-include=health")))
+
+    # Pod health is the fabricHealthTotal topology/pod-N/health, node health is the healthInst under each node's
+    # topology/pod-N/node-N/sys
+    pod_health = {}
+    for fabricHealthTotal in fabricHealths:
+        attributes = fabricHealthTotal["fabricHealthTotal"]["attributes"]
+        if pod_of(attributes["dn"]) is not None and "/node-" not in attributes["dn"]:
+            pod_health[pod_of(attributes["dn"])] = attributes
+
+    node_health = {}
+    for topSystem in topSystems:
+        dn = topSystem["topSystem"]["attributes"]["dn"]
+        for child in topSystem["topSystem"].get("children", []):
+            if "healthInst" in child:
+                node_health[dn[:-len("/sys")]] = int(child["healthInst"]["attributes"]["cur"])
+
+    infra_info = collections.defaultdict(list)
+    pods = sorted(int(fabricPod["fabricPod"]["attributes"]["id"]) for fabricPod in fabricPods)
 
-            for fabricNode in root.iter("fabricNode"):
-                fabric_node = fabricNode.get("name")
-                model_node = fabricNode.get("model")
-                serial_node = fabricNode.get("serial")
-                infra_info[f"pod{i}"].append({'node': fabric_node, 'model': model_node, 'serial': serial_node})
-            for fabricHealthTotal in root.iter("fabricHealthTotal"):
-                fabric_prev = fabricHealthTotal.get("prev")
-                fabric_change = fabricHealthTotal.get("chng")
-                fabric_health = fabricHealthTotal.get("cur")
+    for fabricNode in fabricNodes:
+        attributes = fabricNode["fabricNode"]["attributes"]
+        infra_info[f"pod{pod_of(attributes['dn'])}"].append({'node': attributes["name"], 'model': attributes["model"],
+                                                             'serial': attributes["serial"],
+                                                             'health': node_health.get(attributes["dn"])})
 
-            infra_info[f"pod{i}"].append({'uri': uri, 'health': int(fabric_health), 'prehealth': int(fabric_prev), 'change': int(fabric_change)})
+    for pod in pods:
+        health = pod_health.get(pod, {})
+        uri = f"https://{apic}/api/node/mo/topology/pod-{pod}.json"
+        infra_info[f"pod{pod}"].append({'uri': uri, 'health': int(health.get("cur", 0)),
+                                        'prehealth': int(health.get("prev", 0)), 'change': int(health.get("chng", 0))})
 
-    return infra_info
+    return {f"pod{pod}": infra_info[f"pod{pod}"] for pod in pods}
 
 
 class AciOps:
@@ -50,6 +75,21 @@ class AciOps:
         self.epg_array = []
         self.vrf_array = []
         self.json_header = headers = {'content-type': 'application/json'}
+        self.prefetch = PREFETCH_PAGES
+
+    def view_names(self, uri, class_name, names):
+
+        """Fills names with the name of every class_name object the query returns, read page by page so only the names
+        are kept however many objects there are"""
+
+        separator = "&" if "?" in uri else "?"
+        uri = f"{uri}{separator}order-by={class_name}.name"
+
+        names.clear()
+        names.extend(attributes["name"] for attributes in
+                     iter_class_attributes(self.session, uri, class_name, prefetch=self.prefetch))
+
+        return names
 
     def view_tenants(self):
 
@@ -57,20 +97,7 @@ class AciOps:
 
         uri = "https://{}/api/class/fvTenant.json".format(self.apic)
 
-        request = self.session.get(uri, verify=False)
-        response_dict = request.json()
-        total_count = int(response_dict["totalCount"])
-
-        try:
-            index = 0
-            self.tenant_array.clear()
-            for i in range(0, total_count):
-                self.tenant_array.append(response_dict["imdata"][index]["fvTenant"]["attributes"]["name"])
-                index = index + 1
-        except IndexError:
-            pass
-
-        return self.tenant_array
+        return self.view_names(uri, "fvTenant", self.tenant_array)
 
     def view_tenant_vrf(self, tenant=None):
 
@@ -78,19 +105,8 @@ class AciOps:
 
         uri = "https://{}/api/node/mo/uni/tn-{}.json?query-target=children&target-subtree-class=fvCtx"\
                                                                             .format(self.apic, tenant)
-        request = self.session.get(uri, verify=False)
-        response = json.loads(request.text)
 
-        try:
-            index = 0
-            self.vrf_array.clear()
-            for i in range(0, 100):
-                self.vrf_array.append(response["imdata"][index]["fvCtx"]["attributes"]["name"])
-                index = index + 1
-        except IndexError:
-            pass
-
-        return self.vrf_array
+        return self.view_names(uri, "fvCtx", self.vrf_array)
 
     def view_bd(self, tenant=None):
 
@@ -98,17 +114,8 @@ class AciOps:
 
         uri = "https://{}/api/node/mo/uni/tn-{}.json?query-target=children&target-subtree-class=fvBD"\
                                                                             .format(self.apic, tenant)
-        request = self.session.get(uri, verify=False)
-        response = json.loads(request.text)
-        total_count = int(response["totalCount"])
-
-        index = 0
-        self.bd_array.clear()
-        for i in range(0, total_count):
-            self.bd_array.append(response["imdata"][index]["fvBD"]["attributes"]["name"])
-            index = index + 1
 
-        return self.bd_array
+        return self.view_names(uri, "fvBD", self.bd_array)
 
     def view_app_profiles(self, tenant=None):
 
@@ -116,17 +123,8 @@ class AciOps:
 
         uri = "https://{}/api/node/mo/uni/tn-{}.json?query-target=children&target-subtree-class=fvAp"\
                                                                             .format(self.apic, tenant)
-        request = self.session.get(uri, verify=False)
-        response = json.loads(request.text)
-        total_count = int(response["totalCount"])
 
-        index = 0
-        self.ap_array.clear()
-        for i in range(0, total_count):
-            self.ap_array.append(response["imdata"][index]["fvAp"]["attributes"]["name"])
-            index = index + 1
-
-        return self.ap_array
+        return self.view_names(uri, "fvAp", self.ap_array)
 
     def view_epgs(self, tenant=None, app=None):
 
@@ -134,17 +132,8 @@ class AciOps:
 
         uri = "https://{}/api/node/mo/uni/tn-{}/ap-{}.json?query-target=children&target-subtree-class=fvAEPg"\
                                                                                 .format(self.apic, tenant, app)
-        request = self.session.get(uri, verify=False)
-        response = json.loads(request.text)
-        total_count = int(response["totalCount"])
-
-        index = 0
-        self.epg_array.clear()
-        for i in range(0, total_count):
-            self.epg_array.append(response["imdata"][index]["fvAEPg"]["attributes"]["name"])
-            index = index + 1
 
-        return self.epg_array
+        return self.view_names(uri, "fvAEPg", self.epg_array)
 
 
 class AciOpsSend(AciOps):
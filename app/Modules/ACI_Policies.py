@@ -1,24 +1,211 @@
 """Helper functions to get Cisco ACI policies"""
 
 import xml.etree.ElementTree as ET
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple
 import collections
+import time
+from app.Modules.ApicQuery import run_concurrent, run_alongside, iter_bounded, iter_xml_objects, iter_xml_checked, \
+    ApicError
+from app.Modules.SnapshotRefresher import SnapshotRefresher
 
-vlan_dict = collections.defaultdict(list)
-policies_dict = collections.defaultdict(list)
-aaep_dict = collections.defaultdict(list)
+VLAN_SLOTS = 4096
+MAX_VLAN = 4094
+
+# Vlans per or filtered class query in bulk lookups, keeps the query string at a size the APIC accepts. At most
+# BULK_IN_FLIGHT of those queries run at once
+BULK_FILTER_SIZE = 100
+BULK_IN_FLIGHT = 4
+
+# Policy snapshots are rebuilt in the background and never served older than SNAPSHOT_MAX_AGE seconds. Lookups wait at
+# most SNAPSHOT_WAIT seconds for the first snapshot of an APIC
+SNAPSHOT_MAX_AGE = 300
+SNAPSHOT_WAIT = 60
+
+# Snapshot refreshers, keyed by APIC
+refreshers = {}
+
+# L3Out indexes built on demand while the snapshot has none, per APIC (built time, index). Rebuilt once older than
+# the TTL
+L3OUT_INDEX_TTL = 300
+l3out_indexes = {}
 
 # ----------------------Begin Policy Helper functions------------------------------
 
 
-def get_vlan_ranges(begin_range, end_range):
-    """Expands vlan ranged from vlan pools"""
+class VlanBlocks:
+    """Compact vlan membership for a pool. Encap blocks are kept as integer ranges with a 4096 bit
+    bitmap beside them, so memory doesn't grow with the width of the pool"""
 
-    vlans = []
-    for vlan in range(int(begin_range), int(end_range) + 1):
-        vlans.append(str(vlan))
+    __slots__ = ("bitmap", "ranges")
 
-    return vlans
+    def __init__(self, ranges=None):
+
+        self.bitmap = 0
+        self.ranges = []
+
+        for begin_range, end_range in ranges or []:
+            self.add(begin_range, end_range)
+
+    def add(self, begin_range, end_range) -> None:
+        """Adds an encap block, inclusive on both ends"""
+
+        begin_range, end_range = int(begin_range), int(end_range)
+        self.ranges.append((begin_range, end_range))
+        self.bitmap |= ((1 << (end_range - begin_range + 1)) - 1) << begin_range
+
+    def __contains__(self, vlan) -> bool:
+
+        try:
+            vlan = int(vlan)
+        except (TypeError, ValueError):
+            return False
+
+        return 0 <= vlan < VLAN_SLOTS and bool(self.bitmap >> vlan & 1)
+
+    def __iter__(self):
+
+        bitmap = self.bitmap
+        while bitmap:
+            low_bit = bitmap & -bitmap
+            yield low_bit.bit_length() - 1
+            bitmap ^= low_bit
+
+    def __len__(self) -> int:
+        return bin(self.bitmap).count("1")
+
+    def __bool__(self) -> bool:
+        return bool(self.bitmap)
+
+    def __or__(self, other):
+        return VlanBlocks.from_bitmap(self.bitmap | other.bitmap)
+
+    def __and__(self, other):
+        return VlanBlocks.from_bitmap(self.bitmap & other.bitmap)
+
+    def union(self, other):
+        """Vlans in either pool"""
+        return self | other
+
+    def overlap(self, other):
+        """Vlans found in both pools"""
+        return self & other
+
+    def overlaps(self, other) -> bool:
+        return bool(self.bitmap & other.bitmap)
+
+    @classmethod
+    def from_bitmap(cls, bitmap):
+        """Builds blocks from a bitmap, collapsing set bits back into ranges"""
+
+        blocks = cls()
+        blocks.bitmap = bitmap
+        begin_range = None
+        previous = None
+
+        for vlan in blocks:
+            if begin_range is None:
+                begin_range = vlan
+            elif vlan != previous + 1:
+                blocks.ranges.append((begin_range, previous))
+                begin_range = vlan
+            previous = vlan
+
+        if begin_range is not None:
+            blocks.ranges.append((begin_range, previous))
+
+        return blocks
+
+    def __repr__(self):
+        return f"VlanBlocks({self.ranges})"
+
+
+class PolicySnapshot(NamedTuple):
+
+    """Immutable view of one APIC's access policies. Each refresh builds a new snapshot with a higher version, nothing
+    is changed in place"""
+
+    apic: str
+    version: int
+    taken_at: float
+    vlan_pools: Mapping
+    policies: Mapping
+    aaeps: Mapping
+    vlan_index: tuple
+    l3out_index: Mapping
+    pool_domains: Mapping
+    domain_aaeps: Mapping
+
+    def pools_for_vlan(self, vlan) -> list:
+        """Returns the vlan pools a vlan is assigned to using the vlan index"""
+
+        try:
+            vlan_id = int(vlan)
+        except (TypeError, ValueError):
+            return []
+
+        if not 0 <= vlan_id < VLAN_SLOTS:
+            return []
+
+        return sorted(self.vlan_index[vlan_id])
+
+    def resolve_encap_chain(self, vlan) -> tuple:
+        """Follows vlan -> pools -> domains -> aaeps through the adjacency maps, cost is the size of the answer"""
+
+        pools = self.pools_for_vlan(vlan)
+        phy_doms = list(dict.fromkeys(dom for pool in pools for dom in self.pool_domains.get(pool, ())))
+        aaeps = list(dict.fromkeys(aaep for dom in phy_doms for aaep in self.domain_aaeps.get(dom, ())))
+
+        return pools, phy_doms, aaeps
+
+
+def get_vlan_ranges(begin_range, end_range) -> range:
+    """Returns the vlan range of an encap block without expanding it"""
+
+    return range(int(begin_range), int(end_range) + 1)
+
+
+def reverse_map(mapping) -> dict:
+    """Reverses a one to many map, e.g. domain -> pools becomes pool -> domains"""
+
+    reverse = collections.defaultdict(list)
+    for key, values in mapping.items():
+        for value in values:
+            if key not in reverse[value]:
+                reverse[value].append(key)
+
+    return reverse
+
+
+def build_vlan_index(pools) -> tuple:
+    """Builds vlan to pool index from parsed vlan pools, slot N holds the names of every pool containing vlan N"""
+
+    index = [set() for _ in range(VLAN_SLOTS)]
+    for pool_name, blocks in pools.items():
+        for begin_range, end_range in blocks.ranges:
+            for vlan in get_vlan_ranges(begin_range, end_range):
+                index[vlan].add(pool_name)
+
+    return tuple(frozenset(pools) for pools in index)
+
+
+def parse_vlan_list(vlans) -> list:
+    """Expands a vlan list such as 100-399,1200 to sorted vlan ids, raises ValueError on invalid input"""
+
+    parsed = set()
+    for item in vlans.replace(" ", "").split(","):
+        if not item:
+            continue
+
+        begin_range, _, end_range = item.partition("-")
+        begin_range, end_range = int(begin_range), int(end_range or begin_range)
+
+        if not 1 <= begin_range <= end_range <= MAX_VLAN:
+            raise ValueError(f"Invalid vlan range {item}")
+
+        parsed.update(get_vlan_ranges(begin_range, end_range))
+
+    return sorted(parsed)
 
 
 def find_policy_groups(dn) -> str:
@@ -49,38 +236,25 @@ def find_paths(dn) -> tuple:
     return path, path_ep
 
 
-def request_pools(session, apic) -> Any:
-    """Request configuration from APIC."""
+def request_pools(session, apic):
+    """Request configuration from APIC. Streams the encap blocks, yielding dn and from of each. Raises ApicError if
+    the APIC answers with an error"""
 
-    root = None
     uri = f"https://{apic}/api/node/mo/uni/infra.xml?query-target=subtree&target-subtree-class=fvnsVlanInstP&" \
           f"target-subtree-class=fvnsEncapBlk&query-target=subtree&rsp-subtree=full&rsp-subtree-class=tagAliasInst"
-    response = session.get(uri, verify=False)
 
-    # Check to see if the config in the reponse is valid. Returns to login if exception is raised
-    try:
-        root = ET.fromstring(response.text)
-    except ET.ParseError:
-        print("Something went wrong. Please try again")
-
-    return root
+    for _, fvnsEncapBlk in iter_xml_checked(session, uri, {"fvnsEncapBlk": ("dn", "from")}):
+        yield fvnsEncapBlk
 
 
-def request_domains(session, apic) -> Any:
-    """Request ACI domain types"""
+def request_domains(session, apic):
+    """Request ACI domain types. Streams (class, attributes) for domain to aaep and domain to pool relations. Raises
+    ApicError if the APIC answers with an error"""
 
-    root = None
     uri = f"https://{apic}/api/node/mo/uni.xml?query-target=subtree&target-subtree-class=physDomP&target-subtree-class" \
           f"=infraRsVlanNs,infraRtDomP&query-target=subtree"
 
-    response = session.get(uri, verify=False)
-
-    try:
-        root = ET.fromstring(response.text)
-    except ET.ParseError:
-        print("Something went wrong. Please try again")
-
-    return root
+    yield from iter_xml_checked(session, uri, {"infraRtDomP": ("dn",), "infraRsVlanNs": ("dn", "tDn")})
 
 
 def request_policy_attachments(session, apic, vlan) -> Any:
@@ -103,24 +277,104 @@ def request_policy_attachments(session, apic, vlan) -> Any:
     return root
 
 
-def request_l3_attachments(session, apic) -> Any:
-    """Request current policy enformation for encap for Outs"""
+def request_attachment_encaps(session, apic) -> list:
+    """Request every EPG path attachment in the fabric, returns the vlan id of each one. The response is streamed
+    and only the encap is kept, raises ApicError if the APIC answers with an error"""
 
-    root = None
-    uri = f"https://{apic}/api/class/l3extRsPathL3OutAtt.xml"
+    vlans = []
+    uri = f"https://{apic}/api/class/fvRsPathAtt.xml"
 
-    response = session.get(uri, verify=False)
+    for _, fvRsPathAtt in iter_xml_checked(session, uri, {"fvRsPathAtt": ("encap",)}):
+        encap = fvRsPathAtt.get("encap") or ""
+        if encap.startswith("vlan-") and encap[5:].isdigit():
+            vlans.append(int(encap[5:]))
+
+    return vlans
+
+
+def request_bulk_policy_attachments(session, apic, vlans) -> dict:
+    """Request EPG attachments for several encaps with one or filtered class query, returns DNs keyed by vlan. Raises
+    ApicError if the APIC answers with an error"""
+
+    attachments = collections.defaultdict(list)
+    encaps = ",".join(f"eq(fvRsPathAtt.encap,\"vlan-{vlan}\")" for vlan in vlans)
+    if len(vlans) > 1:
+        encaps = f"or({encaps})"
+    uri = f"https://{apic}/api/class/fvRsPathAtt.xml?query-target-filter={encaps}"
+
+    for _, fvRsPathAtt in iter_xml_checked(session, uri, {"fvRsPathAtt": ("dn", "encap")}):
+        attachments[fvRsPathAtt.get("encap").strip("vlan-")].append(fvRsPathAtt.get("dn"))
+
+    return attachments
+
+
+def batch_policy_attachments(session, apic, vlans) -> tuple:
+    """request_bulk_policy_attachments for one batch, returns (attachments, None) or (None, the APIC error)"""
 
     try:
-        root = ET.fromstring(response.text)
-    except ET.ParseError:
-        print("Something went wrong. Please try again")
+        return request_bulk_policy_attachments(session, apic, vlans), None
+    except ApicError as error:
+        return None, str(error)
 
-    # If reponse has totalcount of 0, notify user that encap wasnt found
-    if response.text.rfind("totalCount=\"0\"") != -1 or response.text.rfind("error code") != -1:
-        print("\n######## No External Policy Assigned ##########")
 
-    return root
+def request_l3_attachments(session, apic, vlan=None):
+    """Request current policy enformation for encap for Outs. Filtered on the APIC when a vlan is given. Streams
+    (class, attributes) with dn and encap of each attachment, or the APIC error"""
+
+    uri = f"https://{apic}/api/class/l3extRsPathL3OutAtt.xml"
+    if vlan is not None:
+        uri = f"{uri}?query-target-filter=eq(l3extRsPathL3OutAtt.encap,\"vlan-{vlan}\")"
+
+    yield from iter_xml_objects(session, uri, {"l3extRsPathL3OutAtt": ("dn", "encap"), "error": ("code", "text")})
+
+
+def build_l3out_index(session, apic) -> dict:
+    """Builds encap keyed L3Out attachment index from one class query, None if the response couldn't be read"""
+
+    index = collections.defaultdict(list)
+
+    for tag, l3extRsPathL3OutAtt in request_l3_attachments(session, apic):
+        if tag == "error":
+            return None
+
+        encap = l3extRsPathL3OutAtt.get("encap").strip("vlan-")
+        index[encap].append(l3extRsPathL3OutAtt.get("dn"))
+
+    return index
+
+
+def get_l3out_index(session, apic, snapshot) -> Mapping:
+    """Returns the snapshot's L3Out index. A snapshot whose L3Out pull failed has none, then an index built on demand
+    is used until it ages past L3OUT_INDEX_TTL. None if that can't be built either"""
+
+    if snapshot.l3out_index is not None:
+        return snapshot.l3out_index
+
+    built, index = l3out_indexes.get(apic, (None, None))
+    if built is None or time.monotonic() - built > L3OUT_INDEX_TTL:
+        index = build_l3out_index(session, apic)
+        if index is None:
+            return None
+        index = freeze_map(index)
+        l3out_indexes[apic] = (time.monotonic(), index)
+
+    return index
+
+
+def find_l3_attachments(session, apic, vlan, snapshot) -> list:
+    """Returns L3Out attachment DNs for a vlan. Read from the L3Out index while one is available, otherwise asks the
+    APIC for the single encap"""
+
+    index = get_l3out_index(session, apic, snapshot)
+    if index is not None:
+        return list(index.get(str(vlan), ()))
+
+    dns = []
+    for tag, l3extRsPathL3OutAtt in request_l3_attachments(session, apic, vlan=vlan):
+        if tag == "l3extRsPathL3OutAtt":
+            dns.append(l3extRsPathL3OutAtt.get("dn"))
+
+    return dns
 
 
 # ^^^^^^^^^^^^^^^^^^^^ End Policy Helper functions ^^^^^^^^^^^^^^^^^^^^
@@ -128,15 +382,13 @@ def request_l3_attachments(session, apic) -> Any:
 # ----------------------Begin Policy functions------------------------------
 
 
-def vlan_pools(session, apic) -> None:
+def vlan_pools(session, apic) -> dict:
 
     """Parses vlan pool names and assigned vlans"""
-    global vlan_dict
 
-    vlan_dict = collections.defaultdict(list)
-    root = request_pools(session, apic)
+    vlan_dict = collections.defaultdict(VlanBlocks)
 
-    for fvnsEncapBlk in root.iter("fvnsEncapBlk"):
+    for fvnsEncapBlk in request_pools(session, apic):
         if "vxlan" in fvnsEncapBlk.get("from"):
             continue
         else:
@@ -144,91 +396,154 @@ def vlan_pools(session, apic) -> None:
             pool_name = dn.split("[")[1].split("]")[0]
             begin_range = dn.split("[")[2].split("-")[1].strip("]")
             end_range = dn.split("[")[3].split("-")[1].strip("]")
-            vlans = get_vlan_ranges(begin_range, end_range)
-            vlan_dict[pool_name].append(vlans)
+            vlan_dict[pool_name].add(begin_range, end_range)
 
+    return vlan_dict
 
-def domains(session, apic) -> None:
-    """Parses DNs for ACI policy data store to aaep dictionary"""
 
-    global policies_dict, aaep_dict
+def domains(session, apic) -> tuple:
+    """Parses DNs for ACI policy data store to aaep dictionary"""
 
     policies_dict = collections.defaultdict(list)
     aaep_dict = collections.defaultdict(list)
-    root = request_domains(session, apic)
-
-    # Map AAEP to domains, l3, phy, vmm
-    for infraRtDomP in root.iter("infraRtDomP"):
-        dn = infraRtDomP.get("dn")
-
-        if dn.rfind("phys-") != -1:
-            aaeps = dn.split("/")[4].strip("attentp-").strip("]")
-            phy_dom = dn.split("/")[1].strip("phys-")
-            aaep_dict[f"{aaeps}"].append(phy_dom)
-        elif dn.rfind("l3dom") != -1:
-            aaeps = dn.split("/")[4].strip("attentp-").strip("]")
-            l3_dom = dn.split("/")[1].strip("l3dom-")
-            aaep_dict[f"{aaeps}"].append(l3_dom)
-        elif dn.rfind("vmmp-") != -1:
-            aaeps = dn.split("/")[5].strip("attentp-").strip("]")
-            vmm_dom = dn.split("/")[1].strip("vmmp-")
-            aaep_dict[f"{aaeps}"].append(vmm_dom)
-        else:
-            continue
 
-    # Map vlan pool to domains, l3, phy, vmm
-    for infraRsVlanNs in root.iter("infraRsVlanNs"):
-
-        vl_pool_dn = infraRsVlanNs.get("tDn")
-        dom_dn = infraRsVlanNs.get("dn")
-
-        if dom_dn.rfind("phys-") != -1:
-            domain = dom_dn.split("/")[1].strip("phys-")
-            vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
-            policies_dict[domain].append(vlan_pool)
-        elif dom_dn.rfind("l3dom-") != -1:
-            domain = dom_dn.split("/")[1].strip("l3dom-")
-            vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
-            policies_dict[domain].append(vlan_pool)
-        elif dom_dn.rfind("vmmp-") != -1:
-            domain = dom_dn.split("/")[1].strip("vmmp-")
-            vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
-            policies_dict[domain].append(vlan_pool)
-        else:
-            continue
+    for tag, attributes in request_domains(session, apic):
+        if tag == "infraRtDomP":
+            map_aaep(attributes, aaep_dict)
+        elif tag == "infraRsVlanNs":
+            map_vlan_pool(attributes, policies_dict)
 
+    return policies_dict, aaep_dict
+
+
+def map_aaep(infraRtDomP, aaep_dict) -> None:
+    """Map AAEP to domains, l3, phy, vmm"""
+
+    dn = infraRtDomP.get("dn")
+
+    if dn.rfind("phys-") != -1:
+        aaeps = dn.split("/")[4].strip("attentp-").strip("]")
+        phy_dom = dn.split("/")[1].strip("phys-")
+        aaep_dict[f"{aaeps}"].append(phy_dom)
+    elif dn.rfind("l3dom") != -1:
+        aaeps = dn.split("/")[4].strip("attentp-").strip("]")
+        l3_dom = dn.split("/")[1].strip("l3dom-")
+        aaep_dict[f"{aaeps}"].append(l3_dom)
+    elif dn.rfind("vmmp-") != -1:
+        aaeps = dn.split("/")[5].strip("attentp-").strip("]")
+        vmm_dom = dn.split("/")[1].strip("vmmp-")
+        aaep_dict[f"{aaeps}"].append(vmm_dom)
+
+
+def map_vlan_pool(infraRsVlanNs, policies_dict) -> None:
+    """Map vlan pool to domains, l3, phy, vmm"""
+
+    vl_pool_dn = infraRsVlanNs.get("tDn")
+    dom_dn = infraRsVlanNs.get("dn")
+
+    if dom_dn.rfind("phys-") != -1:
+        domain = dom_dn.split("/")[1].strip("phys-")
+        vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
+        policies_dict[domain].append(vlan_pool)
+    elif dom_dn.rfind("l3dom-") != -1:
+        domain = dom_dn.split("/")[1].strip("l3dom-")
+        vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
+        policies_dict[domain].append(vlan_pool)
+    elif dom_dn.rfind("vmmp-") != -1:
+        domain = dom_dn.split("/")[1].strip("vmmp-")
+        vlan_pool = vl_pool_dn.split("[")[1].split("]")[0]
+        policies_dict[domain].append(vlan_pool)
+
+
+def freeze_map(mapping) -> Mapping:
+    """Read only copy of a one to many map"""
+
+    return MappingProxyType({key: tuple(values) for key, values in mapping.items()})
 
-def map_policy_configurations(session, apic, vlan) -> tuple:
-    """Finds the requested encap locations and configurations"""
 
-    pools = []
-    phy_doms = []
-    aaeps = []
+def build_snapshot(session, apic, version=1) -> PolicySnapshot:
+    """Loads pools, domains and L3Out attachments at the same time and freezes them into a snapshot"""
+
+    pools, (policies, aaeps), l3out_index = run_concurrent((vlan_pools, session, apic),
+                                                           (domains, session, apic),
+                                                           (build_l3out_index, session, apic))
+
+    return PolicySnapshot(apic=apic, version=version, taken_at=time.time(),
+                          vlan_pools=MappingProxyType(dict(pools)),
+                          policies=freeze_map(policies),
+                          aaeps=freeze_map(aaeps),
+                          vlan_index=build_vlan_index(pools),
+                          l3out_index=None if l3out_index is None else freeze_map(l3out_index),
+                          pool_domains=freeze_map(reverse_map(policies)),
+                          domain_aaeps=freeze_map(reverse_map(aaeps)))
+
+
+def start_snapshots(apic, get_session, max_age=SNAPSHOT_MAX_AGE) -> SnapshotRefresher:
+    """Starts background snapshot refresh for an APIC. Each rebuild asks get_session() for the current session.
+    Logging in again asks for a rebuild, lookups keep using the current snapshot meanwhile"""
+
+    refresher = refreshers.get(apic)
+
+    if refresher is None:
+        refresher = SnapshotRefresher(f"policies-{apic}", lambda version: build_snapshot(get_session(), apic, version),
+                                      max_age)
+        refreshers[apic] = refresher
+    else:
+        refresher.max_age = max_age
+        refresher.refresh()
+
+    refresher.start()
+
+    return refresher
+
+
+def stop_snapshots(apic) -> None:
+    """Stops and drops the snapshot refresher of an APIC, e.g. once logged in to another one"""
+
+    refresher = refreshers.pop(apic, None)
+    if refresher is not None:
+        refresher.stop()
+
+
+def policy_snapshot(session, apic) -> PolicySnapshot:
+    """Returns the current snapshot for the APIC, building one inline if no refresher is running or it has none yet"""
+
+    refresher = refreshers.get(apic)
+    if refresher is None:
+        return build_snapshot(session, apic)
+
+    return refresher.current(timeout=SNAPSHOT_WAIT) or build_snapshot(session, apic)
+
+
+def policy_changed(apic, event) -> None:
+    """Subscription feed listener for fvnsEncapBlk, a changed encap block asks for a snapshot rebuild"""
+
+    refresher = refreshers.get(apic)
+    if refresher is not None:
+        refresher.refresh()
+
+
+def resolve_encap(snapshot, vlan, l3_dns, epg_dns) -> tuple:
+    """Maps a vlan and its L3Out/EPG attachment DNs to pools, domains, aaeps, locations and paths"""
+
     location = []
     paths = []
 
-    # Request L3Outs attachments, parse strings
-    root = request_l3_attachments(session, apic)
-    for l3extRsPathL3OutAtt in root.iter("l3extRsPathL3OutAtt"):
-        encap = l3extRsPathL3OutAtt.get('encap').strip("vlan-")
-        if vlan == encap:
-            dn = l3extRsPathL3OutAtt.get("dn")
-            path = find_paths(dn)
-
-            tenant = dn.split("/")[1].strip("tn-")
-            l3out = dn.split("/")[2].strip("out-")
-            interface = dn.split("/")[4].strip("lifp-")
+    # Find L3Outs attachments, parse strings
+    for dn in l3_dns:
+        path = find_paths(dn)
 
-            location.append(f" Tenant: {tenant}")
-            paths.append(f"EP: {path[1]}")
-            location.append(f"L3Out: {l3out}")
-            location.append(f"Interface: {interface}")
+        tenant = dn.split("/")[1].strip("tn-")
+        l3out = dn.split("/")[2].strip("out-")
+        interface = dn.split("/")[4].strip("lifp-")
 
-    # Request EPG attachments, parse strings
-    root = request_policy_attachments(session, apic, vlan)
-    for fvRsPathAtt in root.iter("fvRsPathAtt"):
-        dn = fvRsPathAtt.get("dn")
+        location.append(f" Tenant: {tenant}")
+        paths.append(f"EP: {path[1]}")
+        location.append(f"L3Out: {l3out}")
+        location.append(f"Interface: {interface}")
 
+    # Parse EPG attachments strings
+    for dn in epg_dns:
         path = find_paths(dn)
         ply_group = find_policy_groups(dn)
 
@@ -244,27 +559,61 @@ def map_policy_configurations(session, apic, vlan) -> tuple:
     # Remove duplicate locations
     locations = list(dict.fromkeys(location))
 
-    # Check if request encap is assigned to any vlan pools
-    for vlan_pool, vlans in vlan_dict.items():
-        for i in vlans:
-            for index in i:
-                if vlan == index:
-                    pools.append(vlan_pool)
-
-    # Cross reference pools name with pools assigned to domains
-    for pool in pools:
-        for dom_type, vl_pool in policies_dict.items():
-            if pool in vl_pool:
-                phy_doms.append(dom_type)
-
-    # Cross reference domains assigned to aaeps and domains assign to vlan pools
-    for aaep, dom in aaep_dict.items():
-        if list(set(dom) & set(phy_doms)):
-            aaeps.append(aaep)
+    # Pools the encap is assigned to, and the domains and aaeps using them
+    pools, phy_doms, aaeps = snapshot.resolve_encap_chain(vlan)
 
     if not pools:
         pools.append(0)
 
     return pools, phy_doms, aaeps, locations, paths
 
+
+def map_policy_configurations(session, apic, vlan) -> tuple:
+    """Finds the requested encap locations and configurations"""
+
+    # EPG attachments don't depend on the snapshot, request them while it's fetched. The snapshot may wait on its
+    # refresher, which queries through the pool, so it's read in this thread
+    snapshot, root = run_alongside((policy_snapshot, session, apic),
+                                   (request_policy_attachments, session, apic, vlan))
+
+    l3_dns = find_l3_attachments(session, apic, vlan, snapshot)
+    epg_dns = [fvRsPathAtt.get("dn") for fvRsPathAtt in root.iter("fvRsPathAtt")]
+
+    return resolve_encap(snapshot, vlan, l3_dns, epg_dns)
+
+
+def bulk_policy_configurations(session, apic, vlans):
+    """Finds locations and configurations for many vlans. The snapshot and L3Out index are read before this returns,
+    so an APIC error there raises ApicError to the caller. Returns a generator of one result per vlan, in order, as
+    each batch of EPG attachments comes back"""
+
+    snapshot = policy_snapshot(session, apic)
+    l3_index = get_l3out_index(session, apic, snapshot)
+    if l3_index is None:
+        raise ApicError(f"{apic}: L3Out attachments couldn't be read")
+
+    batches = [vlans[i:i + BULK_FILTER_SIZE] for i in range(0, len(vlans), BULK_FILTER_SIZE)]
+    results = iter_bounded(lambda batch: batch_policy_attachments(session, apic, batch), batches, BULK_IN_FLIGHT)
+
+    return iter_bulk_results(snapshot, l3_index, batches, results)
+
+
+def iter_bulk_results(snapshot, l3_index, batches, results):
+    """Yields one result per vlan of each batch. A batch whose EPG attachments couldn't be read yields its vlans with
+    the error, the stream has already started so it can't fail the request"""
+
+    for batch, (epg_index, error) in zip(batches, results):
+        for vlan in batch:
+            vlan = str(vlan)
+            if error is not None:
+                yield {"vlan": vlan, "pools": [], "domains": [], "aaeps": [], "locations": [], "paths": [],
+                       "error": error}
+                continue
+
+            pools, phy_doms, aaeps, locations, paths = resolve_encap(snapshot, vlan,
+                                                                     l3_index.get(vlan, ()),
+                                                                     epg_index.get(vlan, []))
+            yield {"vlan": vlan, "pools": [pool for pool in pools if pool != 0], "domains": phy_doms,
+                   "aaeps": aaeps, "locations": locations, "paths": paths, "error": None}
+
 # ^^^^^^^^^^^^^^^^^^^^ End Policy Funtions^^^^^^^^^^^^^^^^^^^^
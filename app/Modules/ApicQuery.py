@@ -0,0 +1,248 @@
+"""Shared helpers for issuing APIC queries"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+import itertools
+import threading
+import time
+
+# Bounded pool for independent APIC round trips. Kept under the default requests connection pool size
+MAX_WORKERS = 8
+WORKER_PREFIX = "apic-query"
+
+# Objects per page for paginated class queries
+PAGE_SIZE = 1000
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix=WORKER_PREFIX)
+
+# Request rate limiters, keyed by APIC
+limiters = {}
+
+
+class ApicError(Exception):
+
+    """The APIC answered a query with an error, e.g. an expired token, instead of the objects asked for"""
+
+
+def iter_concurrent(*calls):
+    """Runs independent requests at the same time, calls are (function, arg, ...) tuples. Results are yielded in call
+    order as soon as each one is ready, exceptions are raised to the caller"""
+
+    # Calls made from a worker run inline so a full pool can't wait on itself
+    if threading.current_thread().name.startswith(WORKER_PREFIX):
+        for func, *args in calls:
+            yield func(*args)
+        return
+
+    futures = [_executor.submit(func, *args) for func, *args in calls]
+
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def run_concurrent(*calls) -> list:
+    """Runs independent requests at the same time and returns all results in call order"""
+
+    return list(iter_concurrent(*calls))
+
+
+def run_alongside(local, *calls) -> list:
+    """Runs local, a (function, arg, ...) tuple, in the calling thread while calls run in the pool. For work that may
+    wait on a background thread that itself queries through the pool, e.g. a snapshot, so it never holds a worker.
+    Returns the local result followed by the call results"""
+
+    func, *args = local
+    if threading.current_thread().name.startswith(WORKER_PREFIX):
+        return [func(*args)] + [call(*call_args) for call, *call_args in calls]
+
+    futures = [_executor.submit(call, *call_args) for call, *call_args in calls]
+
+    try:
+        result = func(*args)
+        return [result] + [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_bounded(func, items, window=MAX_WORKERS):
+    """Calls func(item) for every item with at most window calls running, yields results in item order. Items are
+    read only as calls finish, so a long or unbounded iterable is never held in memory"""
+
+    if threading.current_thread().name.startswith(WORKER_PREFIX):
+        for item in items:
+            yield func(item)
+        return
+
+    pending = deque()
+
+    try:
+        for item in items:
+            pending.append(_executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class RateLimiter:
+
+    """Token bucket shared by every thread querying one APIC. acquire() blocks until a request may be sent"""
+
+    def __init__(self, rate, burst=None):
+
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def rate_limiter(apic, rate) -> RateLimiter:
+    """Returns the limiter of an APIC, created on first use. A different rate replaces the old one's"""
+
+    limiter = limiters.setdefault(apic, RateLimiter(rate))
+    if limiter.rate != rate:
+        limiter.rate = limiter.burst = rate
+
+    return limiter
+
+
+def iter_xml_objects(session, uri, classes):
+    """Streams an xml query and yields (class, attributes) for each object of the requested classes as it's parsed.
+    classes maps class name to the attribute names to keep, None keeps them all. Elements are cleared once read, so
+    memory is bounded by one object rather than the whole response. APIC errors, and responses that can't be parsed,
+    come back as the error class when it's requested"""
+
+    response = session.get(uri, verify=False, stream=True)
+    response.raw.decode_content = True
+
+    root = None
+    depth = 0
+
+    try:
+        for event, element in ET.iterparse(response.raw, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if element.tag in classes:
+                wanted = classes[element.tag]
+                if wanted is None:
+                    yield element.tag, dict(element.attrib)
+                else:
+                    yield element.tag, {name: element.get(name) for name in wanted}
+
+            element.clear()
+
+            # Drop finished top level objects from the root so it doesn't keep a list of every object
+            if depth == 1:
+                root.clear()
+    except ET.ParseError as error:
+        print("Something went wrong. Please try again")
+        if "error" in classes:
+            yield "error", {"code": None, "text": str(error)}
+    finally:
+        response.close()
+
+
+def iter_xml_checked(session, uri, classes):
+    """iter_xml_objects for loaders that must not mistake a failed query for an empty one, an APIC error or a
+    response that can't be parsed raises ApicError"""
+
+    for tag, attributes in iter_xml_objects(session, uri, {**classes, "error": ("code", "text")}):
+        if tag == "error":
+            raise ApicError(f"{uri}: {attributes['code']} {attributes['text']}")
+
+        yield tag, attributes
+
+
+def read_json(uri, response) -> dict:
+    """Returns the body of a json query. Raises ApicError if the APIC answers with an error or the response can't be
+    parsed, so a failed query is never read as an empty one"""
+
+    try:
+        body = response.json()
+    except ValueError as error:
+        raise ApicError(f"{uri}: {error}") from error
+
+    for mo in body.get("imdata", []):
+        if "error" in mo:
+            attributes = mo["error"].get("attributes", {})
+            raise ApicError(f"{uri}: {attributes.get('code')} {attributes.get('text')}")
+
+    return body
+
+
+def fetch_json_page(session, uri, page, page_size=PAGE_SIZE) -> dict:
+    """Returns one page of a json query as the response body, raises ApicError like read_json"""
+
+    separator = "&" if "?" in uri else "?"
+    response = session.get(f"{uri}{separator}page={page}&page-size={page_size}", verify=False)
+
+    return read_json(uri, response)
+
+
+def iter_json_pages(session, uri, page_size=PAGE_SIZE, prefetch=0):
+    """Yields the imdata objects of a json query one page at a time using the APIC page and page-size options. The uri
+    should carry an order-by so pages don't shift while they're read. With prefetch, the first page's totalCount is
+    used to request up to that many of the following pages at once, they're still yielded in order and no more than
+    prefetch pages are held at a time. Raises ApicError on a failed page"""
+
+    body = fetch_json_page(session, uri, 0, page_size)
+    imdata = body.get("imdata", [])
+    yield from imdata
+
+    total = int(body.get("totalCount", 0))
+    if len(imdata) < page_size or page_size >= total:
+        return
+
+    if prefetch:
+        pages = iter_bounded(lambda page: fetch_json_page(session, uri, page, page_size),
+                             range(1, -(-total // page_size)), prefetch)
+    else:
+        pages = (fetch_json_page(session, uri, page, page_size) for page in itertools.count(1))
+
+    for page, body in enumerate(pages, start=1):
+        imdata = body.get("imdata", [])
+        yield from imdata
+
+        if len(imdata) < page_size or (page + 1) * page_size >= int(body.get("totalCount", 0)):
+            return
+
+
+def iter_class_attributes(session, uri, class_name, page_size=PAGE_SIZE, prefetch=0):
+    """Yields the attributes of every object of one class returned by a paginated json query, other classes in the
+    response are skipped"""
+
+    for mo in iter_json_pages(session, uri, page_size, prefetch):
+        if class_name in mo:
+            yield mo[class_name]["attributes"]
@@ -0,0 +1,100 @@
+"""Resolves large lists of MACs and IPs to their fabric location, one result at a time"""
+
+import csv
+import io
+import ipaddress
+import re
+import requests
+from app.Modules.ApicQuery import iter_bounded, rate_limiter, ApicError
+from app.Modules.EndpointTracker import endpoints_by_ip, endpoints_by_mac, last_endpoint, endpoint_location
+
+# Lookups running at once for one job, and APIC queries per second shared by every job against an APIC
+MAX_IN_FLIGHT = 8
+QUERIES_PER_SECOND = 20
+
+# Columns of each result, in CSV order
+RESULT_FIELDS = ("endpoint", "mac", "ip", "tenant", "ap", "epg", "encap", "paths", "leafs", "error")
+
+# Header cells skipped when they show up in the input
+HEADER_NAMES = {"mac", "ip", "endpoint", "address", "mac address", "ip address"}
+
+
+def normalize_mac(value):
+    """Returns a MAC in APIC form, AA:BB:CC:DD:EE:FF, from colon, dash or dotted notation. None if it isn't a MAC"""
+
+    digits = re.sub(r"[:.\-]", "", value)
+    if len(digits) != 12 or not re.fullmatch(r"[0-9A-Fa-f]{12}", digits):
+        return None
+
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2)).upper()
+
+
+def iter_endpoint_values(lines):
+    """Yields the first cell of each CSV row or line, skipping blanks and header cells"""
+
+    for row in csv.reader(lines):
+        value = next((cell.strip() for cell in row if cell.strip()), None)
+        if value is None or value.lower() in HEADER_NAMES:
+            continue
+
+        yield value
+
+
+def resolve_endpoint(value, get_session, apic, index=None, limiter=None) -> dict:
+    """Finds one MAC or IP, returns a result row. Lookups that go to the APIC, no index or an index miss, wait on the
+    limiter and use the session get_session() returns at that moment, so a long job follows re-logins"""
+
+    result = dict.fromkeys(RESULT_FIELDS)
+    result["endpoint"] = value
+
+    try:
+        ipaddress.IPv4Address(value)
+        lookup, key = endpoints_by_ip, value
+    except ipaddress.AddressValueError:
+        lookup, key = endpoints_by_mac, normalize_mac(value)
+
+    if key is None:
+        result["error"] = "Not an ip or mac"
+        return result
+
+    try:
+        fvCEp = last_endpoint(lookup(key, get_session(), apic, index, limiter))
+    except (requests.exceptions.RequestException, ApicError) as error:
+        result["error"] = str(error)
+        return result
+
+    if fvCEp is None:
+        result["error"] = "Not found"
+        return result
+
+    result["tenant"], result["ap"], result["epg"] = endpoint_location(fvCEp)
+    result.update(mac=fvCEp["mac"], ip=fvCEp["ip"], encap=fvCEp["encap"], paths=fvCEp["paths"],
+                  leafs=fvCEp["leafs"])
+
+    return result
+
+
+def bulk_endpoints(values, get_session, apic, index=None, rate=QUERIES_PER_SECOND):
+    """Resolves every value with at most MAX_IN_FLIGHT lookups running, yields result rows in input order.
+    get_session() is asked for the session on every lookup"""
+
+    limiter = rate_limiter(apic, rate)
+
+    return iter_bounded(lambda value: resolve_endpoint(value, get_session, apic, index, limiter), values,
+                        MAX_IN_FLIGHT)
+
+
+def csv_rows(results):
+    """Yields a CSV header and then one CSV line per result"""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=RESULT_FIELDS)
+    writer.writeheader()
+
+    for result in results:
+        writer.writerow({**result, "paths": ", ".join(result["paths"] or []), "leafs": ", ".join(result["leafs"] or [])})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
@@ -0,0 +1,264 @@
+"""Records endpoint location changes in the database and answers location and move queries from it"""
+
+import datetime
+import ipaddress
+import threading
+import traceback
+from sqlalchemy import and_, func
+from app import db
+from app.base.models import EndpointLocation
+import app.Modules.EndpointIndex as EpIndex
+from app.Modules.EndpointTracker import endpoint_location
+
+# Rows written per insert and commit
+BATCH_SIZE = 500
+
+# Most locations returned by one query
+MAX_LOCATIONS = 5000
+
+# Seconds between removing rows older than the retention period
+PRUNE_INTERVAL = 3600
+
+# Running collectors, keyed by APIC
+collectors = {}
+
+
+def utc_now() -> datetime.datetime:
+
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def parse_time(value, default=None):
+    """Reads an ISO 8601 time as naive UTC, times without an offset are taken as UTC. Raises ValueError if bad"""
+
+    if not value:
+        return default
+
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def location_key(endpoint) -> tuple:
+    """Everything that makes up where an endpoint is, a change in any of it is recorded. Every ip of the endpoint is
+    part of it, not only the primary one"""
+
+    return (tuple(sorted(EpIndex.endpoint_ips(endpoint))), endpoint["encap"], tuple(sorted(endpoint["leafs"])),
+            ", ".join(endpoint["paths"]))
+
+
+def location_rows(apic, endpoint, seen_at) -> list:
+    """Table rows for an endpoint's current location, one per leaf and ip. A missing leaf or ip is a row with none"""
+
+    tenant, ap, epg = endpoint_location(endpoint)
+    row = {"apic": apic, "dn": endpoint["dn"], "mac": endpoint["mac"], "tenant": tenant, "ap": ap, "epg": epg,
+           "encap": endpoint["encap"], "paths": ", ".join(endpoint["paths"]), "seen_at": seen_at}
+
+    return [dict(row, leaf=leaf, ip=ip) for leaf in sorted(endpoint["leafs"]) or [None]
+            for ip in sorted(EpIndex.endpoint_ips(endpoint)) or [None]]
+
+
+def save_rows(rows) -> None:
+
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.bulk_insert_mappings(EndpointLocation, rows[i:i + BATCH_SIZE])
+        db.session.commit()
+
+
+def group_locations(rows) -> list:
+    """Folds the per leaf and ip rows of each recorded change into one location. ip is the first of its ips"""
+
+    locations = {}
+    for row in rows:
+        location = locations.get((row.dn, row.seen_at))
+        if location is None:
+            location = locations[(row.dn, row.seen_at)] = dict(row.to_dict(), leafs=[], ips=[])
+            del location["leaf"]
+        if row.leaf is not None and row.leaf not in location["leafs"]:
+            location["leafs"].append(row.leaf)
+        if row.ip is not None and row.ip not in location["ips"]:
+            location["ips"].append(row.ip)
+
+    return list(locations.values())
+
+
+def endpoint_filter(endpoint):
+    """Column condition for a MAC or IP"""
+
+    try:
+        ipaddress.IPv4Address(endpoint)
+        return EndpointLocation.ip == endpoint
+    except ipaddress.AddressValueError:
+        return EndpointLocation.mac == endpoint.upper()
+
+
+def rows_for(changes) -> list:
+    """Every row of the changes selected by a (dn, seen_at) subquery"""
+
+    changes = changes.limit(MAX_LOCATIONS).subquery()
+
+    return db.session.query(EndpointLocation) \
+        .join(changes, and_(EndpointLocation.dn == changes.c.dn, EndpointLocation.seen_at == changes.c.seen_at)) \
+        .order_by(EndpointLocation.seen_at, EndpointLocation.dn, EndpointLocation.leaf, EndpointLocation.ip).all()
+
+
+def location_at(apic, endpoint, when) -> list:
+    """Where a MAC or IP was at a given time, one location per endpoint DN it was learned under"""
+
+    changes = db.session.query(EndpointLocation.dn, func.max(EndpointLocation.seen_at).label("seen_at")) \
+        .filter(EndpointLocation.apic == apic, endpoint_filter(endpoint), EndpointLocation.seen_at <= when) \
+        .group_by(EndpointLocation.dn)
+
+    return group_locations(rows_for(changes))
+
+
+def moves(apic, since, until, leaf=None, endpoint=None) -> list:
+    """Location changes between two times, optionally only those onto a leaf or of one MAC or IP, oldest first"""
+
+    conditions = [EndpointLocation.apic == apic, EndpointLocation.seen_at >= since, EndpointLocation.seen_at <= until]
+    if leaf:
+        conditions.append(EndpointLocation.leaf == leaf)
+    if endpoint:
+        conditions.append(endpoint_filter(endpoint))
+
+    changes = db.session.query(EndpointLocation.dn, EndpointLocation.seen_at).filter(*conditions).distinct() \
+        .order_by(EndpointLocation.seen_at)
+
+    return group_locations(rows_for(changes))
+
+
+class HistoryCollector:
+
+    """Compares the endpoint index with the last recorded location of every endpoint on a daemon thread and writes
+    the ones that changed. The endpoint's modTs is used as the change time when it's newer than the last recorded
+    one, otherwise the time it was noticed"""
+
+    def __init__(self, app, apic, interval, retention_days):
+
+        self.app = app
+        self.apic = apic
+        self.interval = interval
+        self.retention_days = retention_days
+        self.last = None
+        self._pruned = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"history-{self.apic}", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+
+        self._stop.set()
+
+    def load_last(self) -> dict:
+        """Last recorded location and time of every endpoint, so a restart doesn't record them all again"""
+
+        changes = db.session.query(EndpointLocation.dn, func.max(EndpointLocation.seen_at).label("seen_at")) \
+            .filter(EndpointLocation.apic == self.apic).group_by(EndpointLocation.dn).subquery()
+        rows = db.session.query(EndpointLocation) \
+            .join(changes, and_(EndpointLocation.dn == changes.c.dn, EndpointLocation.seen_at == changes.c.seen_at))
+
+        leafs = {}
+        ips = {}
+        last = {}
+        for row in rows:
+            if row.leaf is not None:
+                leafs.setdefault(row.dn, set()).add(row.leaf)
+            if row.ip is not None:
+                ips.setdefault(row.dn, set()).add(row.ip)
+            last[row.dn] = (row.encap, row.paths, row.seen_at)
+
+        return {dn: ((tuple(sorted(ips.get(dn, ()))), encap, tuple(sorted(leafs.get(dn, ()))), paths), seen_at)
+                for dn, (encap, paths, seen_at) in last.items()}
+
+    def collect(self) -> int:
+        """Records endpoints whose location changed since the last pass, returns the rows written"""
+
+        index = EpIndex.get_index(self.apic)
+        if index is None:
+            return 0
+
+        if self.last is None:
+            self.last = self.load_last()
+
+        now = utc_now()
+        rows = []
+        present = set()
+
+        for endpoint in index.endpoints():
+            dn = endpoint["dn"]
+            present.add(dn)
+            key = location_key(endpoint)
+            recorded = self.last.get(dn)
+            if recorded is not None and recorded[0] == key:
+                continue
+
+            try:
+                seen_at = min(parse_time(endpoint["modified"], now), now)
+            except ValueError:
+                seen_at = now
+            if recorded is not None and seen_at <= recorded[1]:
+                seen_at = now
+
+            self.last[dn] = (key, seen_at)
+            rows.extend(location_rows(self.apic, endpoint, seen_at))
+
+        # Endpoints that aged out are recorded again if they come back
+        for dn in set(self.last) - present:
+            del self.last[dn]
+
+        save_rows(rows)
+
+        return len(rows)
+
+    def prune(self) -> None:
+
+        cutoff = utc_now() - datetime.timedelta(days=self.retention_days)
+        db.session.query(EndpointLocation).filter(EndpointLocation.apic == self.apic,
+                                                  EndpointLocation.seen_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        self._pruned = utc_now()
+
+    def _run(self) -> None:
+
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    self.collect()
+                    if self._pruned is None or utc_now() - self._pruned > datetime.timedelta(seconds=PRUNE_INTERVAL):
+                        self.prune()
+                except Exception:
+                    traceback.print_exc()
+                    db.session.rollback()
+                    self.last = None
+                finally:
+                    db.session.remove()
+
+                self._stop.wait(self.interval)
+
+
+def start_collector(app, apic, interval, retention_days) -> HistoryCollector:
+    """Starts recording endpoint history for an APIC, one collector per APIC"""
+
+    if apic not in collectors:
+        collectors[apic] = HistoryCollector(app, apic, interval, retention_days)
+
+    collector = collectors[apic]
+    collector.start()
+
+    return collector
+
+
+def stop_collector(apic) -> None:
+    """Stops and drops the collector of an APIC, e.g. once logged in to another one"""
+
+    collector = collectors.pop(apic, None)
+    if collector is not None:
+        collector.stop()
@@ -0,0 +1,338 @@
+"""In process MAC/IP endpoint index kept current with modTs based delta pulls"""
+
+import bisect
+import ipaddress
+import threading
+import time
+from array import array
+from app.Modules.ApicQuery import iter_json_pages, ApicError
+from app.Modules.EndpointTracker import parse_endpoints, endpoint_location, ENDPOINT_CLASSES
+from app.Modules.SnapshotRefresher import SnapshotRefresher
+
+# Seconds between delta pulls, and between full pulls which also drop endpoints the fabric has aged out
+DELTA_INTERVAL = 30
+FULL_SYNC_INTERVAL = 900
+
+# Seconds login warm-up waits for the first full pull, large fabrics take a while
+INDEX_WAIT = 300
+
+# Most DNs put in one or() filter when reloading endpoints named by change events
+RELOAD_FILTER_SIZE = 100
+
+# Most addresses returned by one prefix search
+MAX_PREFIX_RESULTS = 5000
+
+# Endpoint indexes and their refreshers, keyed by APIC
+indexes = {}
+
+
+class EndpointIndex:
+
+    """Endpoints of one APIC keyed by DN, with MAC and IP maps pointing at the DNs. Records are replaced, never
+    changed in place, so a record handed to a caller stays consistent. IPv4 addresses are also kept as a sorted array
+    of integers so prefix searches are two bisects"""
+
+    def __init__(self, apic):
+
+        self.apic = apic
+        self.ready = False
+        self.last_modified = None
+        self.last_full_sync = None
+        self.pending = set()
+        self.listeners = set()
+        self._lock = threading.Lock()
+        self._by_dn = {}
+        self._by_mac = {}
+        self._by_ip = {}
+        self._ip_array = array("L")
+
+    def endpoint_uri(self, modified_after=None, dns=None) -> str:
+
+        uri = f"https://{self.apic}/api/node/class/fvCEp.json?rsp-subtree=full&rsp-subtree-class={ENDPOINT_CLASSES}" \
+              f"&order-by=fvCEp.dn"
+        if modified_after is not None:
+            uri = f"{uri}&query-target-filter=gt(fvCEp.modTs,\"{modified_after}\")"
+        elif dns:
+            dn_filter = ",".join(f'eq(fvCEp.dn,"{dn}")' for dn in dns)
+            uri = f"{uri}&query-target-filter=or({dn_filter})" if len(dns) > 1 else \
+                f"{uri}&query-target-filter={dn_filter}"
+
+        return uri
+
+    def pull(self, session, modified_after=None, dns=None) -> list:
+        """Pulls endpoints page by page, all of them, only those changed after modified_after or only those in dns.
+        Raises ApicError if the APIC answers with an error, so a failed pull never empties the index"""
+
+        endpoints = []
+        for fvCEp in iter_json_pages(session, self.endpoint_uri(modified_after, dns)):
+            endpoints.extend(parse_endpoints({"imdata": [fvCEp]}))
+
+        return endpoints
+
+    def full_sync(self, session) -> None:
+        """Rebuilds every map from a full pull and swaps them in"""
+
+        by_dn, by_mac, by_ip = {}, {}, {}
+        endpoints = self.pull(session)
+        for endpoint in endpoints:
+            add_endpoint(endpoint, by_dn, by_mac, by_ip)
+
+        ip_array = array("L", sorted(n for n in map(ip_int, by_ip) if n is not None))
+
+        with self._lock:
+            if self.ready:
+                for dn, endpoint in by_dn.items():
+                    self._notify(self._by_dn.get(dn), endpoint)
+            self._by_dn, self._by_mac, self._by_ip, self._ip_array = by_dn, by_mac, by_ip, ip_array
+            self.last_modified = max((endpoint["modified"] for endpoint in endpoints if endpoint["modified"]),
+                                     default=None)
+            self.last_full_sync = time.monotonic()
+            self.ready = True
+
+    def delta_sync(self, session) -> list:
+        """Pulls endpoints modified since the newest one seen and replaces their records, returns them"""
+
+        # Without a modTs to filter on the pull would be the whole class, an empty fabric is picked up by change
+        # events and the next full pull instead
+        if not self.last_modified:
+            return []
+
+        endpoints = self.pull(session, modified_after=self.last_modified)
+
+        with self._lock:
+            for endpoint in endpoints:
+                self._replace(endpoint["dn"], endpoint)
+                if (endpoint["modified"] or "") > (self.last_modified or ""):
+                    self.last_modified = endpoint["modified"]
+
+        return endpoints
+
+    def reload_pending(self, session, skip=()) -> None:
+        """Pulls endpoints named by change events again, those the APIC no longer has are dropped"""
+
+        with self._lock:
+            dns = sorted(self.pending - set(skip))
+            self.pending.clear()
+
+        for i in range(0, len(dns), RELOAD_FILTER_SIZE):
+            chunk = dns[i:i + RELOAD_FILTER_SIZE]
+            try:
+                endpoints = self.pull(session, dns=chunk)
+            except ApicError:
+                # Keep the rest for the next pass
+                with self._lock:
+                    self.pending.update(dns[i:])
+                raise
+            with self._lock:
+                for dn in chunk:
+                    self._replace(dn, None)
+                for endpoint in endpoints:
+                    self._replace(endpoint["dn"], endpoint)
+
+    def sync(self, session):
+        """Full pull when the index is new or due one, otherwise a delta pull plus endpoints named by change events"""
+
+        if not self.ready or time.monotonic() - self.last_full_sync > FULL_SYNC_INTERVAL:
+            self.pending.clear()
+            self.full_sync(session)
+        else:
+            changed = self.delta_sync(session)
+            self.reload_pending(session, skip=[endpoint["dn"] for endpoint in changed])
+
+        return self
+
+    def _replace(self, dn, endpoint) -> None:
+        """Swaps the record of a DN for endpoint, or drops it when endpoint is None. Caller holds the lock"""
+
+        old = self._by_dn.get(dn)
+        self._notify(old, endpoint)
+        touched = (endpoint_ips(old) if old else set()) | (endpoint_ips(endpoint) if endpoint else set())
+
+        remove_endpoint(dn, self._by_dn, self._by_mac, self._by_ip)
+        if endpoint is not None:
+            add_endpoint(endpoint, self._by_dn, self._by_mac, self._by_ip)
+
+        for ip in touched:
+            n = ip_int(ip)
+            if n is None:
+                continue
+            i = bisect.bisect_left(self._ip_array, n)
+            indexed = i < len(self._ip_array) and self._ip_array[i] == n
+            if ip in self._by_ip and not indexed:
+                self._ip_array.insert(i, n)
+            elif indexed and ip not in self._by_ip:
+                del self._ip_array[i]
+
+    def _notify(self, old, new) -> None:
+        """Calls every listener with both records when an endpoint moved to other leafs or paths. Runs under the
+        lock, so listeners must be quick"""
+
+        if not self.listeners or old is None or new is None:
+            return
+
+        before, after = endpoint_place(old), endpoint_place(new)
+        if before != after and before[0] and after[0]:
+            for listener in list(self.listeners):
+                listener(old, new)
+
+    def remove(self, dn) -> None:
+
+        with self._lock:
+            self._replace(dn, None)
+
+    def mark_changed(self, dn) -> None:
+
+        with self._lock:
+            self.pending.add(dn)
+
+    def by_mac(self, mac) -> list:
+
+        with self._lock:
+            return [self._by_dn[dn] for dn in sorted(self._by_mac.get(mac.upper(), ()))]
+
+    def by_ip(self, ip) -> list:
+
+        with self._lock:
+            return [self._by_dn[dn] for dn in sorted(self._by_ip.get(ip, ()))]
+
+    def by_prefix(self, network, limit=None) -> tuple:
+        """Endpoints with an address inside an IPv4Network, as (ip, record) pairs in address order. Returns how many
+        addresses matched and the pairs, cut to limit"""
+
+        with self._lock:
+            low = bisect.bisect_left(self._ip_array, int(network.network_address))
+            high = bisect.bisect_right(self._ip_array, int(network.broadcast_address))
+            end = high if limit is None else min(high, low + limit)
+
+            matches = []
+            for n in self._ip_array[low:end]:
+                ip = str(ipaddress.IPv4Address(n))
+                matches.extend((ip, self._by_dn[dn]) for dn in sorted(self._by_ip[ip]))
+
+        return high - low, matches
+
+    def endpoints(self) -> list:
+        """Every endpoint record at this moment"""
+
+        with self._lock:
+            return list(self._by_dn.values())
+
+    def __len__(self) -> int:
+        return len(self._by_dn)
+
+
+def ip_int(ip):
+    """An IPv4 address as an integer, None for anything else"""
+
+    try:
+        return int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+
+
+def endpoint_place(endpoint) -> tuple:
+    """Where an endpoint sits, its leafs and paths"""
+
+    return tuple(sorted(endpoint["leafs"])), tuple(endpoint["paths"])
+
+
+def endpoint_ips(endpoint) -> set:
+
+    return (set(endpoint["ips"]) | {endpoint["ip"]}) - {None, "", "0.0.0.0"}
+
+
+def add_endpoint(endpoint, by_dn, by_mac, by_ip) -> None:
+
+    dn = endpoint["dn"]
+    by_dn[dn] = endpoint
+    by_mac.setdefault((endpoint["mac"] or "").upper(), set()).add(dn)
+    for ip in endpoint_ips(endpoint):
+        by_ip.setdefault(ip, set()).add(dn)
+
+
+def remove_endpoint(dn, by_dn, by_mac, by_ip) -> None:
+
+    endpoint = by_dn.pop(dn, None)
+    if endpoint is None:
+        return
+
+    discard_key(by_mac, (endpoint["mac"] or "").upper(), dn)
+    for ip in endpoint_ips(endpoint):
+        discard_key(by_ip, ip, dn)
+
+
+def discard_key(mapping, key, dn) -> None:
+    """Removes a DN from a MAC or IP entry, and the entry once no DN is left"""
+
+    dns = mapping.get(key)
+    if dns is not None:
+        dns.discard(dn)
+        if not dns:
+            del mapping[key]
+
+
+def start_index(apic, get_session, interval=DELTA_INTERVAL) -> SnapshotRefresher:
+    """Starts background sync of the endpoint index for an APIC, each sync asks get_session() for the current session"""
+
+    if apic not in indexes:
+        index = EndpointIndex(apic)
+        refresher = SnapshotRefresher(f"endpoints-{apic}", lambda version: index.sync(get_session()), interval * 2)
+        indexes[apic] = (index, refresher)
+
+    index, refresher = indexes[apic]
+    refresher.start()
+
+    return refresher
+
+
+def stop_index(apic) -> None:
+    """Stops the sync of an APIC's endpoint index and drops the index, e.g. once logged in to another one"""
+
+    index, refresher = indexes.pop(apic, (None, None))
+    if refresher is not None:
+        refresher.stop()
+
+
+def endpoint_changed(apic, event) -> None:
+    """Subscription feed listener for fvCEp and fvIp. Deleted endpoints are dropped right away, anything else is
+    queued for the refresh thread which is woken to pull it"""
+
+    index, refresher = indexes.get(apic, (None, None))
+    if index is None or not index.ready:
+        return
+
+    if event["status"] != "resync":
+        dn = event["dn"].split("/ip-[")[0]
+        if event["class"] == "fvCEp" and event["status"] == "deleted":
+            index.remove(dn)
+            return
+        index.mark_changed(dn)
+
+    refresher.refresh()
+
+
+def prefix_search(index, prefix, limit=MAX_PREFIX_RESULTS) -> dict:
+    """Every endpoint learned inside a prefix such as 10.20.0.0/16, host bits are ignored so a gateway like
+    10.1.1.1/24 works too. Raises ValueError if the prefix isn't IPv4"""
+
+    network = ipaddress.IPv4Network(prefix.strip(), strict=False)
+    total, matches = index.by_prefix(network, limit)
+
+    endpoints = []
+    for ip, endpoint in matches:
+        tenant, ap, epg = endpoint_location(endpoint)
+        endpoints.append({"ip": ip, "mac": endpoint["mac"], "tenant": tenant, "ap": ap, "epg": epg,
+                          "encap": endpoint["encap"], "paths": endpoint["paths"], "leafs": endpoint["leafs"]})
+
+    return {"prefix": str(network), "total": total, "truncated": limit is not None and total > limit,
+            "endpoints": endpoints}
+
+
+def get_index(apic):
+    """Returns the endpoint index of an APIC once its first full pull has finished, otherwise None"""
+
+    index, _ = indexes.get(apic, (None, None))
+    if index is None or not index.ready:
+        return None
+
+    return index
@@ -1,68 +1,41 @@
 """Helper program/funtions to find endpoint in an ACI Fabric"""
 
 
-import xml.etree.ElementTree as ET
+import ipaddress
 import warnings
 import json
+from app.Modules.ApicQuery import run_concurrent, read_json
 
 # Ignore HTTP warnings
 warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
+# Endpoint children read by parse_endpoints
+ENDPOINT_CLASSES = "fvCEp,fvIp,fvRsCEpToPathEp,fvRsHyper,fvRsToNic,fvRsToVm,fvReportingNode"
 
-def get_endpoint_by_mac(endpoint, session, apic) -> tuple:
-    """Request endpoing data by mac using json and xml"""
 
-    root = None
-    json_to_dict = None
-    uri_xml = f"https://{apic}/api/node/class/fvCEp.xml?rsp-subtree=full&rsp-subtree-class=fvCEp,fvRsCEpToPathEp,fvIp," \
-              f"fvRsHyper,fvRsToNic,fvRsToVm&query-target-filter=eq(fvCEp.mac,\"{endpoint}\""
-    uri_json = f"https://{apic}/api/node/class/fvCEp.json?rsp-subtree=full&rsp-subtree-class=fvCEp,fvRsCEpToPathEp,fvIp," \
-               f"fvRsHyper,fvRsToNic,fvRsToVm&query-target-filter=eq(fvCEp.mac,\"{endpoint}\""
+def request_endpoints(uri, session) -> dict:
+    """Request endpoint data as json. Raises ApicError if the APIC answers with an error, e.g. an expired token, so it
+    isn't mistaken for an endpoint that doesn't exist"""
 
-    # Makes web request
-    xml_reponse = session.get(uri_xml, verify=False)
-    json_response = session.get(uri_json, verify=False)
+    return read_json(uri, session.get(uri, verify=False))
 
-    # Converts xml reponse string to element tree
-    try:
-        root = ET.fromstring(xml_reponse.text)
-    except ET.ParseError:
-        pass
-    # Converts json response to dictionary
-    try:
-        json_to_dict = json.loads(json_response.text)
-    except json.JSONDecodeError:
-        pass
 
-    return root, json_to_dict
+def get_endpoint_by_mac(endpoint, session, apic) -> dict:
+    """Request endpoing data by mac"""
 
+    uri = f"https://{apic}/api/node/class/fvCEp.json?rsp-subtree=full&rsp-subtree-class={ENDPOINT_CLASSES}" \
+          f"&query-target-filter=eq(fvCEp.mac,\"{endpoint}\")"
 
-def get_endpoint_by_ip(endpoint, session, apic) -> tuple:
-    """Request endpoing data by ip using json and xml"""
+    return request_endpoints(uri, session)
 
-    root = None
-    json_to_dict = None
-    uri_xml = f"https://{apic}/api/node/class/fvCEp.xml?rsp-subtree=full&rsp-subtree-include=required&rsp-subtree-filter=" \
-              f"eq(fvIp.addr,\"{endpoint}\""
-    uri_json = f"https://{apic}/api/node/class/fvCEp.json?rsp-subtree=full&rsp-subtree-include=required&rsp-subtree-filter=" \
-               f"eq(fvIp.addr,\"{endpoint}\""
 
-    # Makes web request
-    xml_reponse = session.get(uri_xml, verify=False)
-    json_response = session.get(uri_json, verify=False)
+def get_endpoint_by_ip(endpoint, session, apic) -> dict:
+    """Request endpoing data by ip"""
 
-    # Converts xml reponse string to element tree
-    try:
-        root = ET.fromstring(xml_reponse.text)
-    except ET.ParseError:
-        pass
-    # Converts json response to dictionary
-    try:
-        json_to_dict = json.loads(json_response.text)
-    except json.JSONDecodeError:
-        pass
+    uri = f"https://{apic}/api/node/class/fvCEp.json?rsp-subtree=full&rsp-subtree-include=required&rsp-subtree-filter=" \
+          f"eq(fvIp.addr,\"{endpoint}\")"
 
-    return root, json_to_dict
+    return request_endpoints(uri, session)
 
 
 def parse_policy_group(attribute) -> str:
@@ -92,130 +65,147 @@ def parse_path_group(attribute) -> str:
     return paths
 
 
-def find_ip_endpoints(endpoint, session, apic) -> tuple:
-    """Collect all data about the requested endpoint if ip"""
+def parse_endpoints(response) -> list:
+    """Reads each fvCEp in a json response in one pass. Returns mac, ip, encap, dn, learning source, ips, paths and
+    reporting leafs for every endpoint"""
 
-    leafs = []
-    paths = []
-    encap = None
-    ep_loc = None
-    ep_domain = None
-    endpoint_mac = None
+    endpoints = []
+    for item in response.get("imdata", []):
+        fvCEp = item.get("fvCEp")
+        if fvCEp is None:
+            continue
 
-    # Request endpoint data and iterate through elements/atrributes in tree
-    root = get_endpoint_by_ip(endpoint, session, apic)
-    for fvCEp in root[0].iter("fvCEp"):
-        endpoint_mac = fvCEp.get("mac")
-        encap = fvCEp.get("encap")
-        ep_loc = fvCEp.get("dn")
-        ep_domain = fvCEp.get("lcC")
+        attributes = fvCEp.get("attributes", {})
+        endpoint = {"mac": attributes.get("mac"), "ip": attributes.get("ip"), "encap": attributes.get("encap"),
+                    "dn": attributes.get("dn"), "learning": attributes.get("lcC"), "modified": attributes.get("modTs"),
+                    "ips": [], "paths": [], "leafs": []}
+        parse_endpoint_children(fvCEp.get("children", []), endpoint)
 
-    try:
-        # Using json dictionary, collecting the nodes report the enpoint.
-        for node in root[1].get('imdata', {})[0].get('fvCEp', {}).get('children', {})[0].get('fvIp', {}).get('children',
-                                                                                                             {}):
-            reporting_node = node.get('fvReportingNode', {}).get('attributes', {}).get('id', {})
-            leafs.append(reporting_node)
-    except (IndexError, KeyError):
-        pass
+        if endpoint["ip"] in (None, "", "0.0.0.0") and endpoint["ips"]:
+            endpoint["ip"] = endpoint["ips"][0]
 
-    endpoint_details = display_endpoint_data(ep_loc, encap, ep_domain, endpoint_mac, paths, leafs, endpoint, session, mac=endpoint_mac)
-
-    return endpoint_details
-
-
-def find_mac_endpoints(endpoint, session, apic) -> tuple:
-    """Collect all data about the requested endpoint if mac"""
-
-    leafs = []
-    paths = []
-    encap = None
-    ep_loc = None
-    ep_domain = None
-    ip = None
-
-    # Request endpoint data and iterate through elements/atrributes in tree
-    root = get_endpoint_by_mac(endpoint, session, apic)
-    for fvCEp in root[0].iter("fvCEp"):
-        ip = fvCEp.get("ip")
-        encap = fvCEp.get("encap")
-        ep_loc = fvCEp.get("dn")
-        ep_domain = fvCEp.get("lcC")
-
-    # Request endpoint data and iterate through elements/atrributes collecting path data
-    for fvRsCEpToPathEp in root[0].iter("fvRsCEpToPathEp"):
-        path = parse_path_group(fvRsCEpToPathEp)
-        if path is not None:
-            paths.append(path)
-        path = parse_policy_group(fvRsCEpToPathEp)
-        if path is not None:
-            paths.append(path)
-    try:
-        # Using json dictionary, collecting the nodes report the enpoint.
-        for node in root[1].get('imdata', {})[0].get('fvCEp', {}).get('children', {})[0].get('fvRsHyper', {}).get(
-                'children', {}):
-            reporting_node = node.get('fvReportingNode', {}).get('attributes', {}).get('id', {})
-            leafs.append(reporting_node)
-        for node in root[1].get('imdata', {})[0].get('fvCEp', {}).get('children', {})[0].get('fvRsToVm', {}).get(
-                'children', {}):
-            reporting_node = node.get('fvReportingNode', {}).get('attributes', {}).get("id", {})
-            leafs.append(reporting_node)
-        for node in root[1].get('imdata', {})[0].get('fvCEp', {}).get('children', {})[0].get('fvRsCEpToPathEp', {}).get(
-                'children', {}):
-            reporting_node = node.get('fvReportingNode', {}).get('attributes', {}).get('id', {})
-            leafs.append(reporting_node)
-    except (IndexError, KeyError):
-        pass
+        endpoints.append(endpoint)
+
+    return endpoints
+
+
+def parse_endpoint_children(children, endpoint) -> None:
+    """Walks an endpoint's subtree collecting ips, paths and reporting leafs"""
+
+    for child in children:
+        for child_class, body in child.items():
+            attributes = body.get("attributes", {})
+
+            if child_class == "fvIp":
+                endpoint["ips"].append(attributes.get("addr"))
+            elif child_class == "fvRsCEpToPathEp":
+                for path in (parse_path_group(attributes), parse_policy_group(attributes)):
+                    if path is not None:
+                        endpoint["paths"].append(path)
+            elif child_class == "fvReportingNode" and attributes.get("id") not in endpoint["leafs"]:
+                endpoint["leafs"].append(attributes.get("id"))
+
+            parse_endpoint_children(body.get("children", []), endpoint)
 
-    endpoint_details = display_endpoint_data(ep_loc, encap, ep_domain, ip, paths, leafs, endpoint, session)
 
-    return endpoint_details
+def endpoints_by_ip(endpoint, session, apic, index=None, limiter=None) -> list:
+    """Endpoint records for an ip, read from the endpoint index when one is given. An ip the index has no record of is
+    asked of the APIC, it may have been learned since the last sync. APIC queries wait on the limiter if there is one"""
 
+    endpoints = index.by_ip(endpoint) if index is not None else []
+    if endpoints:
+        return endpoints
 
-def display_endpoint_data(ep_loc, encap, ep_domain, reverse, paths, leafs, endpoint, session, mac=None):
-    """Presents the user with data about the requested endpoint"""
+    if limiter is not None:
+        limiter.acquire()
 
-    tenant = None
-    ap = None
-    epg = None
-    switches = None
-    path = None
-    endpoint_logs = None
+    return parse_endpoints(get_endpoint_by_ip(endpoint, session, apic))
+
+
+def endpoints_by_mac(endpoint, session, apic, index=None, limiter=None) -> list:
+    """Endpoint records for a mac, read from the endpoint index when one is given. A mac the index has no record of is
+    asked of the APIC, it may have been learned since the last sync. APIC queries wait on the limiter if there is one"""
+
+    endpoints = index.by_mac(endpoint) if index is not None else []
+    if endpoints:
+        return endpoints
+
+    if limiter is not None:
+        limiter.acquire()
+
+    return parse_endpoints(get_endpoint_by_mac(endpoint, session, apic))
+
+
+def last_endpoint(endpoints):
+    """The lookups report the last endpoint returned, None if there wasn't one"""
+
+    return endpoints[-1] if endpoints else None
+
+
+def lookup_endpoint(endpoint, session, apic, index=None) -> tuple:
+    """Forward lookup, then reverse lookup and history at the same time. The reverse view reuses the forward response
+    and only queries the APIC when that response came back without path data. Endpoint data is read from the index
+    when one is given. Returns forward, reverse and history"""
 
     try:
+        ipaddress.IPv4Address(endpoint)
+        forward, reverse = "mac", "ip"
+        fvCEp = last_endpoint(endpoints_by_ip(endpoint, session, apic, index))
+    except ipaddress.AddressValueError:
+        forward, reverse = "ip", "mac"
+        fvCEp = last_endpoint(endpoints_by_mac(endpoint, session, apic, index))
+
+    if fvCEp is None:
+        return endpoint_fields(None, forward), endpoint_fields(None, reverse), None
+
+    # IP responses are filtered to the matching fvIp, ask for the MAC's full subtree only when paths are missing
+    calls = [(get_state_transistions, *endpoint_location(fvCEp), fvCEp["mac"], session, apic)]
+    if forward == "mac" and not fvCEp["paths"]:
+        calls.append((endpoints_by_mac, fvCEp["mac"], session, apic, index))
 
+    endpoint_logs, *by_mac = run_concurrent(*calls)
+    reverse_cep = last_endpoint(by_mac[0]) if by_mac else fvCEp
+
+    return endpoint_fields(fvCEp, forward), endpoint_fields(reverse_cep or fvCEp, reverse), endpoint_logs
+
+
+def endpoint_location(fvCEp) -> tuple:
+    """Splits an endpoint DN into tenant, ap and epg"""
+
+    try:
+        ep_loc = fvCEp["dn"]
         tenant = ep_loc.split("/")[1].strip("tn-")
         ap = ep_loc.split("/")[2].strip("ap-")
         epg = ep_loc.split("/")[3].strip("epg-")
-        switches = ', '.join(leafs)
+    except (AttributeError, IndexError, TypeError):
+        return None, None, None
 
-        if paths:
-            path = ', '.join(paths)
-        else:
-            paths = "No Path Attachments"
-    except AttributeError:
-        pass
+    return tenant, ap, epg
 
-    endpoint_logs = get_state_transistions(tenant, ap, epg, endpoint, session, endpoint_mac=endpoint)
 
-    return reverse, tenant, ap, epg, ep_domain, encap, path, switches, endpoint_logs
+def endpoint_fields(fvCEp, reverse) -> tuple:
+    """Endpoint values shown to the user, reverse names the field shown first, mac or ip"""
 
-def get_state_transistions(tenant, ap, epg, endpoint, session, endpoint_mac=None):
+    if fvCEp is None:
+        return None, None, None, None, None, None, None, None
+
+    tenant, ap, epg = endpoint_location(fvCEp)
+    switches = ', '.join(fvCEp["leafs"])
+    path = ', '.join(fvCEp["paths"]) if fvCEp["paths"] else None
+
+    return fvCEp[reverse], tenant, ap, epg, fvCEp["learning"], fvCEp["encap"], path, switches
+
+
+def get_state_transistions(tenant, ap, epg, endpoint_mac, session, apic) -> dict:
     """Gets endpoint fabric current/past status"""
 
-    if endpoint_mac is not None:
-        uri = f"https://192.168.156.11/mqapi2/troubleshoot.eptracker.json?ep=uni/tn-{tenant}/ap-{ap}/epg-{epg}/cep-{endpoint}"
-    else:
-        uri = f"https://192.168.156.11/mqapi2/troubleshoot.eptracker.json?ep=uni/tn-{tenant}/ap-{ap}/epg-{epg}/cep-{endpoint_mac}"
+    uri = f"https://{apic}/mqapi2/troubleshoot.eptracker.json?ep=uni/tn-{tenant}/ap-{ap}/epg-{epg}/cep-{endpoint_mac}"
 
     # Makes web request
-    xml_reponse = session.get(uri, verify=False)
-    json_response = session.get(uri, verify=False)
+    response = session.get(uri, verify=False)
 
     # Converts json response to dictionary
     try:
-        json_to_dict = json.loads(json_response.text)
+        return json.loads(response.text)
     except json.JSONDecodeError:
-        pass
-
-    return json_to_dict
\ No newline at end of file
+        return {"imdata": []}
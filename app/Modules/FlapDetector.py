@@ -0,0 +1,130 @@
+"""Flags endpoints that keep moving between leafs or ports"""
+
+import heapq
+import threading
+import time
+from array import array
+import app.Modules.EndpointIndex as EpIndex
+
+# Flag an endpoint seen moving more than THRESHOLD times within WINDOW seconds
+THRESHOLD = 5
+WINDOW = 300
+
+# Move times kept per endpoint, at least THRESHOLD + 1 are needed to see a flap
+RING_SIZE = 16
+
+# Records between dropping endpoints that haven't moved within the window
+PRUNE_EVERY = 10000
+
+# Running detectors, keyed by APIC
+detectors = {}
+
+
+class MoveRing:
+
+    """The last few move times of one endpoint in a fixed size array, the oldest is overwritten"""
+
+    __slots__ = ("times", "next", "location", "last")
+
+    def __init__(self, size):
+
+        self.times = array("d", [0.0]) * size
+        self.next = 0
+        self.location = None
+        self.last = 0.0
+
+    def add(self, when, location) -> None:
+
+        self.times[self.next] = when
+        self.next = (self.next + 1) % len(self.times)
+        self.location = location
+        self.last = when
+
+    def count_since(self, since) -> int:
+
+        return sum(1 for when in self.times if when >= since)
+
+
+class FlapDetector:
+
+    """Counts endpoint moves per MAC and per IP in ring buffers. Keys with more than threshold moves inside the
+    window are kept in a flagged set until they settle down"""
+
+    def __init__(self, apic, threshold=THRESHOLD, window=WINDOW):
+
+        self.apic = apic
+        self.threshold = threshold
+        self.window = window
+        self.size = max(RING_SIZE, threshold + 1)
+        self.moves = 0
+        self._rings = {}
+        self._flagged = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, kind, location, when=None) -> None:
+        """Adds one move of a MAC or IP"""
+
+        when = when or time.time()
+
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = MoveRing(self.size)
+            ring.add(when, location)
+
+            if ring.count_since(when - self.window) > self.threshold:
+                self._flagged[key] = kind
+
+            self.moves += 1
+            if self.moves % PRUNE_EVERY == 0:
+                self._prune(when)
+
+    def endpoint_moved(self, old, new) -> None:
+        """Endpoint index listener, counts a move for the MAC and each of its IPs"""
+
+        location = f"{', '.join(new['leafs'])} {', '.join(new['paths'])}".strip()
+        when = time.time()
+
+        self.record(new["mac"], "mac", location, when)
+        for ip in EpIndex.endpoint_ips(new):
+            self.record(ip, "ip", location, when)
+
+    def _prune(self, now) -> None:
+
+        since = now - self.window
+        for key in [key for key, ring in self._rings.items() if ring.last < since]:
+            del self._rings[key]
+            self._flagged.pop(key, None)
+
+    def top(self, limit=50) -> list:
+        """Flagged endpoints with the most moves in the window first, those back under the threshold are dropped"""
+
+        since = time.time() - self.window
+        flappers = []
+
+        with self._lock:
+            for key, kind in list(self._flagged.items()):
+                ring = self._rings[key]
+                moves = ring.count_since(since)
+                if moves <= self.threshold:
+                    del self._flagged[key]
+                    continue
+                flappers.append({"endpoint": key, "type": kind, "moves": moves, "location": ring.location,
+                                 "last_move": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ring.last))})
+
+        return heapq.nlargest(limit, flappers, key=lambda flapper: flapper["moves"])
+
+
+def start_detector(apic, threshold=THRESHOLD, window=WINDOW) -> FlapDetector:
+    """Creates the detector of an APIC and attaches it to the APIC's endpoint index, run after start_index"""
+
+    detector = detectors.get(apic)
+    if detector is None:
+        detector = detectors[apic] = FlapDetector(apic, threshold, window)
+    detector.threshold, detector.window = threshold, window
+    detector.size = max(RING_SIZE, threshold + 1)
+
+    index, _ = EpIndex.indexes[apic]
+    index.listeners.add(detector.endpoint_moved)
+
+    return detector
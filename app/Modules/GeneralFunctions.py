@@ -1,11 +1,41 @@
+import threading
 import time
 from app.Modules.FindEncap import apic_login
 import app.base.routes as Routes
 
+# Seconds a login is used before logging in again, under the APIC's default 600 second token timeout
+SESSION_LIFETIME = 540
+
+# The session being aged and when its clock started
+_login_lock = threading.Lock()
+_logged_in = {"session": None, "at": 0.0}
+
 
 def session_time(username, password, apic):
-    session_time = time.perf_counter()
+    """Logs in again once the current session is older than SESSION_LIFETIME, the new one replaces
+    Routes.apic_session"""
+
+    with _login_lock:
+        # A session set by the login page starts its clock the first time it's seen here
+        if Routes.apic_session is not _logged_in["session"]:
+            _logged_in.update(session=Routes.apic_session, at=time.monotonic())
+
+        if Routes.apic_session is not None and time.monotonic() - _logged_in["at"] <= SESSION_LIFETIME:
+            return
 
-    if session_time > 1100:
         apic_session = apic_login(username, password, apic)
-        Routes.apic_session = apic_session
+        if apic_session is not None:
+            Routes.apic_session = apic_session
+            _logged_in.update(session=apic_session, at=time.monotonic())
+
+
+def current_session(apic):
+    """The session background loaders query an APIC with. It's read on every call, so loaders follow a new login
+    and never hold on to an expired token"""
+
+    if Routes.apic != apic or Routes.apic_session is None:
+        raise RuntimeError(f"Not logged in to {apic}")
+
+    session_time(Routes.username, Routes.password, apic)
+
+    return Routes.apic_session
@@ -0,0 +1,190 @@
+"""Keeps the fabric inventory cached and records pod and node health over time"""
+
+import threading
+import time
+from array import array
+from typing import Mapping, NamedTuple
+import app.Modules.ACIOps as AciOps
+from app.Modules.SnapshotRefresher import SnapshotRefresher
+
+# Oldest inventory served to the infra page, and how long a page waits for the first one, in seconds. The poller
+# refreshes at half the max age, which is also the spacing of the health samples
+SNAPSHOT_MAX_AGE = 120
+SNAPSHOT_WAIT = 60
+
+# Health samples kept per pod and node, 24 hours at the default poll interval
+HISTORY_SAMPLES = 1440
+
+# Hours of health shown on the infra page, and points drawn per trend line
+TREND_HOURS = 6
+TREND_POINTS = 60
+
+# Inventory refreshers and health histories, keyed by APIC
+refreshers = {}
+histories = {}
+
+
+class InfraSnapshot(NamedTuple):
+
+    """One poll of the fabric inventory, infra is the ACIOps.infr result"""
+
+    version: int
+    taken: float
+    infra: Mapping
+
+
+class HealthRing:
+
+    """Sample times and health scores of one pod or node in two fixed size arrays, the oldest sample is overwritten"""
+
+    __slots__ = ("times", "scores", "next", "count")
+
+    def __init__(self, size):
+
+        self.times = array("d", [0.0]) * size
+        self.scores = array("b", [0]) * size
+        self.next = 0
+        self.count = 0
+
+    def add(self, when, score) -> None:
+
+        self.times[self.next] = when
+        self.scores[self.next] = score
+        self.next = (self.next + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def samples(self, since=0.0):
+        """Yields (time, score) oldest first"""
+
+        size = len(self.times)
+        for i in range(self.next - self.count, self.next):
+            if self.times[i % size] >= since:
+                yield self.times[i % size], self.scores[i % size]
+
+
+class HealthHistory:
+
+    """Health time series of every pod and node of one APIC. Pods are keyed podN, nodes podN/name"""
+
+    def __init__(self, size=HISTORY_SAMPLES):
+
+        self.size = size
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def record(self, infra, when=None) -> None:
+        """Adds one sample per pod and node from an ACIOps.infr result"""
+
+        when = when or time.time()
+
+        with self._lock:
+            for pod, entries in infra.items():
+                *nodes, health = entries
+                self._add(pod, when, health["health"])
+                for node in nodes:
+                    if node.get("health") is not None:
+                        self._add(f"{pod}/{node['node']}", when, node["health"])
+
+    def _add(self, key, when, score) -> None:
+
+        ring = self._rings.get(key)
+        if ring is None:
+            ring = self._rings[key] = HealthRing(self.size)
+        ring.add(when, score)
+
+    def series(self, key, since=0.0) -> list:
+        """[time, score] samples of a pod or node, oldest first"""
+
+        with self._lock:
+            ring = self._rings.get(key)
+            return [[when, score] for when, score in ring.samples(since)] if ring else []
+
+    def trends(self, since, points=TREND_POINTS) -> dict:
+        """Scores of every pod and node since a time, averaged down to at most points values each"""
+
+        with self._lock:
+            keys = list(self._rings)
+
+        return {key: downsample([score for _, score in self.series(key, since)], points) for key in keys}
+
+
+def downsample(scores, points) -> list:
+    """Averages a list of scores into at most points buckets"""
+
+    if len(scores) <= points:
+        return scores
+
+    step = len(scores) / points
+
+    return [round(sum(bucket) / len(bucket), 1) for bucket in
+            (scores[int(i * step):int((i + 1) * step)] for i in range(points))]
+
+
+def build_infra_snapshot(session, apic, version=0) -> InfraSnapshot:
+    """Polls the fabric inventory and records its health scores"""
+
+    infra = AciOps.infr(session, apic)
+    taken = time.time()
+
+    history = histories.get(apic)
+    if history is not None:
+        history.record(infra, taken)
+
+    return InfraSnapshot(version, taken, infra)
+
+
+def start_poller(apic, get_session, max_age=SNAPSHOT_MAX_AGE) -> SnapshotRefresher:
+    """Starts the background inventory poll for an APIC, each poll asks get_session() for the current session"""
+
+    histories.setdefault(apic, HealthHistory())
+    refresher = refreshers.get(apic)
+
+    if refresher is None:
+        refresher = SnapshotRefresher(f"infra-{apic}",
+                                      lambda version: build_infra_snapshot(get_session(), apic, version), max_age)
+        refreshers[apic] = refresher
+    else:
+        refresher.max_age = max_age
+        refresher.refresh()
+
+    refresher.start()
+
+    return refresher
+
+
+def stop_poller(apic) -> None:
+    """Stops and drops the inventory poll of an APIC, e.g. once logged in to another one. Its health history is kept"""
+
+    refresher = refreshers.pop(apic, None)
+    if refresher is not None:
+        refresher.stop()
+
+
+def infra_snapshot(session, apic) -> InfraSnapshot:
+    """Returns the cached inventory for the APIC, polling inline if no poller is running or it has nothing yet"""
+
+    refresher = refreshers.get(apic)
+    if refresher is None:
+        return build_infra_snapshot(session, apic)
+
+    return refresher.current(timeout=SNAPSHOT_WAIT) or build_infra_snapshot(session, apic)
+
+
+def health_trends(apic, hours=TREND_HOURS, points=TREND_POINTS) -> dict:
+    """Recent health of every pod and node of an APIC, empty until the poller has run"""
+
+    history = histories.get(apic)
+    if history is None:
+        return {}
+
+    return history.trends(time.time() - hours * 3600, points)
+
+
+def health_series(apic, key, hours=TREND_HOURS) -> list:
+    """Every recorded sample of one pod or node within the last hours"""
+
+    history = histories.get(apic)
+    if history is None:
+        return []
+
+    return history.series(key, time.time() - hours * 3600)
@@ -0,0 +1,94 @@
+"""Keeps per APIC snapshots current using a background thread"""
+
+import threading
+import time
+import traceback
+
+# Seconds to wait before retrying a failed rebuild
+RETRY_INTERVAL = 15
+
+
+class SnapshotRefresher:
+
+    """Builds snapshots with the loader on a daemon thread and swaps each new one in atomically. Readers always get
+    the newest complete snapshot and never wait on a rebuild, unless no snapshot exists or it's past max_age"""
+
+    def __init__(self, name, loader, max_age):
+
+        self.name = name
+        self.loader = loader
+        self.max_age = max_age
+        self.version = 0
+        self.error = None
+        self.failures = 0
+        self._snapshot = None
+        self._built = None
+        self._swapped = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Starts the refresh thread, first snapshot is built right away"""
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"refresh-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+
+        self._stop.set()
+        self._wake.set()
+
+    def refresh(self) -> None:
+        """Asks for a rebuild without waiting for it"""
+
+        self._wake.set()
+
+    @property
+    def age(self):
+
+        if self._built is None:
+            return None
+
+        return time.monotonic() - self._built
+
+    def current(self, timeout=None):
+        """Returns the newest snapshot. Waits up to timeout only when there isn't one, or it's older than max_age, and
+        stops waiting as soon as a rebuild fails. None when no snapshot was ever built"""
+
+        with self._swapped:
+            if self._snapshot is None or self.age > self.max_age:
+                failures = self.failures
+                self.refresh()
+                self._swapped.wait_for(lambda: (self._snapshot is not None and self.age <= self.max_age) or
+                                       self.failures != failures, timeout=timeout)
+
+            return self._snapshot
+
+    def _run(self) -> None:
+
+        while not self._stop.is_set():
+            self._wake.clear()
+
+            try:
+                snapshot = self.loader(self.version + 1)
+            except Exception as error:
+                traceback.print_exc()
+                with self._swapped:
+                    self.error = error
+                    self.failures += 1
+                    self._swapped.notify_all()
+                self._wake.wait(RETRY_INTERVAL)
+                continue
+
+            with self._swapped:
+                self.version += 1
+                self.error = None
+                self._snapshot = snapshot
+                self._built = time.monotonic()
+                self._swapped.notify_all()
+
+            # Rebuild at half the max age so a slow or failed rebuild still has time before data goes stale
+            self._wake.wait(self.max_age / 2)
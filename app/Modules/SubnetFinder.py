@@ -1,136 +1,386 @@
 """Helper program for locating subnets in ACI"""
 
 
-import xml.etree.ElementTree as ET
+import bisect
+import collections
+import ipaddress
+import time
 import warnings
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from app.Modules.ApicQuery import iter_xml_checked
+from app.Modules.SnapshotRefresher import SnapshotRefresher
 
 # Check and ignore unverfied http reequest
 warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
+# Classes and attributes read from the fvBD subtree
+SUBNET_CLASSES = {"fvSubnet": ("ip", "dn", "scope"),
+                  "fvBD": ("dn", "name", "ipLearning", "mtu", "limitIpLearnToSubnets", "mac", "unicastRoute",
+                           "unkMacUcastAct"),
+                  "fvRsCtx": ("tnFvCtxName", "dn", "tDn"),
+                  "fvRtBd": ("dn",),
+                  "fvRsBDToOut": ("dn", "tnL3extOutName")}
+
+# fvBD settings copied onto each BD record
+BD_FLAGS = ("ipLearning", "mtu", "limitIpLearnToSubnets", "mac", "unicastRoute", "unkMacUcastAct")
+
+
+# Oldest subnet snapshot served to lookups, and how long a lookup waits for the first one, in seconds
+SNAPSHOT_MAX_AGE = 300
+SNAPSHOT_WAIT = 60
+
+# Gateways returned per typeahead page at most
+MAX_GATEWAY_PAGE = 100
+
+# Subnet snapshot refreshers, keyed by APIC
+refreshers = {}
+
+
+class PrefixTrie:
+
+    """Binary trie over network prefixes of one address family. Each node is [zero child, one child, values], values
+    lists every (network, value) stored under that prefix, BDs whose gateways share a network each keep an entry. A
+    lookup walks at most one node per prefix bit"""
+
+    __slots__ = ("bits", "root", "size")
+
+    def __init__(self, bits):
+
+        self.bits = bits
+        self.root = [None, None, None]
+        self.size = 0
+
+    def insert(self, network, value) -> None:
+
+        node = self.root
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            node[2] = []
+        node[2].append((network, value))
+        self.size += 1
+
+    def longest_match(self, network):
+        """Every entry of the longest stored prefix containing network, as a list of (network, value). None if nothing
+        contains it"""
+
+        node = self.root
+        match = node[2]
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            node = node[(address >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+
+        return match
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class SubnetSnapshot(NamedTuple):
+
+    """Immutable view of one APIC's BD subnets. bds maps BD DN to its record, tries maps VRF DN to a PrefixTrie per
+    IP version. gateways is sorted as text so a typed prefix is a bisect, catalog holds the matching entries"""
+
+    apic: str
+    version: int
+    taken_at: float
+    bds: Mapping
+    tries: Mapping
+    gateways: tuple
+    catalog: tuple
+
+    def find_subnet(self, query) -> list:
+        """Longest matching BD subnets in every VRF for a host IP or prefix, longest prefix first. A VRF can match more
+        than once when BDs share a network, the subnet whose gateway is exactly the query comes first. Each match is
+        (vrf, network, fvSubnet attributes). Raises ValueError if query isn't an address or prefix"""
+
+        interface = ipaddress.ip_interface(query.strip())
+        network = interface.network
+        matches = []
+
+        for vrf, tries in self.tries.items():
+            trie = tries.get(network.version)
+            entries = trie.longest_match(network) if trie is not None else None
+            for entry in entries or ():
+                matches.append((vrf, *entry))
+
+        def exact(match):
+            gateway = gateway_interface(match[2].get("ip"))
+            return gateway is not None and gateway.ip == interface.ip
+
+        return sorted(matches, key=lambda match: (match[1].prefixlen, exact(match)), reverse=True)
+
+    def search_gateways(self, prefix="", offset=0, limit=25) -> tuple:
+        """Catalog entries whose gateway starts with prefix, a page at a time. Returns the total match count and the
+        page"""
+
+        prefix = prefix.strip().lower()
+        low = bisect.bisect_left(self.gateways, prefix)
+        high = bisect.bisect_right(self.gateways, prefix + chr(0x10FFFF))
+        start = min(low + max(offset, 0), high)
+
+        return high - low, self.catalog[start:min(high, start + min(max(limit, 0), MAX_GATEWAY_PAGE))]
+
+
+def gateway_interface(ip):
+    """A gateway address such as 10.1.1.1/24 as an interface, None if it can't be read"""
+
+    try:
+        return ipaddress.ip_interface(ip)
+    except (TypeError, ValueError):
+        return None
+
+
+def subnet_network(ip):
+    """The network of a gateway address such as 10.1.1.1/24, None if it can't be read"""
+
+    interface = gateway_interface(ip)
+
+    return interface.network if interface is not None else None
+
+
+def parent_dn(dn, rn_prefix) -> str:
+    """DN of the object holding a child, e.g. the BD of a subnet DN given "/subnet-[" """
+
+    return dn.split(rn_prefix)[0]
+
 
 def request_subnets(session, apic):
-    """Request ACI subnets, checks response for vailidity"""
+    """Request ACI subnets, streams (class, attributes) for the BD subtree objects. Raises ApicError if the APIC
+    answers with an error"""
 
-    root = None
     uri = f"https://{apic}/api/class/fvBD.xml?query-target=subtree"
-    response = session.get(uri, verify=False)
 
-    try:
-        root = ET.fromstring(response.text)
-    except ET.ParseError:
-        print("Something went wrong. Please try again")
+    yield from iter_xml_checked(session, uri, SUBNET_CLASSES)
 
-    return root
 
+def new_bd_record(dn) -> dict:
 
-def get_subnets(session, apic):
-    """Gets current gateways in ACI"""
+    return {"dn": dn, "name": dn.split("/BD-", 1)[-1], "tenant": dn.split("/")[1][len("tn-"):], "vrf": None,
+            "vrf_dn": None, "subnets": [], "aps": [], "epgs": [], "l3outs": [], **dict.fromkeys(BD_FLAGS)}
 
-    root = request_subnets(session, apic)
-    unicast = []
-    for gateway in root.iter("fvSubnet"):
-        subnets = gateway.get("ip")
-        unicast.append(subnets)
 
-    return root
+def get_bd_records(session, apic) -> dict:
+    """Gets current BDs in ACI in one pass over the BD subtree, returns a record per BD DN with its settings,
+    subnets, VRF, EPGs and L3Outs"""
 
+    bds = {}
 
-def get_gateways(session, apic):
+    def record(dn):
+        bd = bds.get(dn)
+        if bd is None:
+            bd = bds[dn] = new_bd_record(dn)
+        return bd
 
-    gateways = []
+    for tag, attributes in request_subnets(session, apic):
+        if tag == "fvBD":
+            bd = record(attributes["dn"])
+            bd["name"] = attributes.get("name") or bd["name"]
+            bd.update({flag: attributes.get(flag) for flag in BD_FLAGS})
 
-    get_gateway = get_subnets(session, apic)
-    for fvSubnet in get_gateway.iter("fvSubnet"):
-        ip = fvSubnet.get("ip")
-        gateways.append(ip)
+        elif tag == "fvSubnet":
+            record(parent_dn(attributes["dn"], "/subnet-["))["subnets"].append(attributes)
 
-    return gateways
+        # A BD's VRF is its fvRsCtx target, unresolved relations are named under the BD's tenant
+        elif tag == "fvRsCtx":
+            bd = record(parent_dn(attributes["dn"], "/rsctx"))
+            bd["vrf"] = attributes.get("tnFvCtxName")
+            bd["vrf_dn"] = attributes.get("tDn") or f"{parent_dn(bd['dn'], '/BD-')}/ctx-{bd['vrf']}"
 
-def find_gateways(unicast_gateway, session, apic) -> tuple:
-    """Search for ACI Gateways and get configurations"""
+        # uni/tn-T/BD-B/rtbd-[uni/tn-T/ap-A/epg-E]
+        elif tag == "fvRtBd":
+            bd_dn, epg_dn = attributes["dn"].split("/rtbd-[", 1)
+            epg_rns = epg_dn.rstrip("]").split("/")
+            record(bd_dn)["aps"].append(epg_rns[2][len("ap-"):])
+            record(bd_dn)["epgs"].append(epg_rns[3][len("epg-"):])
 
-    get_gateway = get_subnets(session, apic)
+        elif tag == "fvRsBDToOut":
+            bd_dn, l3out = attributes["dn"].split("/rsBDToOut-", 1)
+            record(bd_dn)["l3outs"].append(attributes.get("tnL3extOutName") or l3out)
 
-    aps = []
-    epgs = []
-    l3Outs = []
-    gateways = []
+    return bds
 
-    location, bridge_domain, uni_route, scope, unkwn_uni, tenant, bd_vrf, iplearn = None, "DoesntExist", None, None, None, None, None, None
 
-    try:
-        # Locate subnet in ACI, get scope, map location
-        for fvSubnet in get_gateway.iter("fvSubnet"):
-            ip = fvSubnet.get("ip")
-            gateways.append(ip)
-            if unicast_gateway in ip:
-                location = fvSubnet.get("dn")
-                scope = fvSubnet.get("scope")
-                break
+def freeze_record(record) -> Mapping:
 
-        # Find BD, check to see if unicast routing is enable and unknown unicast setting is
-        for fvBD in get_gateway.iter("fvBD"):
-            bds = fvBD.get("name")
-            iplearn = fvBD.get("ipLearning")
-            mtu = fvBD.get("mtu")
-            learn_limit = fvBD.get("limitIpLearnToSubnets")
-            mac = fvBD.get("mac")
-            if location.rfind(bds) != -1:
-                bridge_domain = bds
-                uni_route = fvBD.get("unicastRoute")
-                unkwn_uni = fvBD.get("unkMacUcastAct")
-
-        # Find vrf associated with BD
-        for fvRsCtx in get_gateway.iter("fvRsCtx"):
-            vrf = fvRsCtx.get("tnFvCtxName")
-            location = fvRsCtx.get("dn")
-            if location.rfind(bridge_domain) != -1:
-                bd_vrf = vrf
-
-        # Find tenant, ap, and epgs, save to list
-        for fvRtBd in get_gateway.iter("fvRtBd"):
-            dn = fvRtBd.get("dn")
-            if dn.rfind(bridge_domain) != -1:
-                tenant = dn.split("/")[1].strip("tn-")
-                aps.append(dn.split("/")[5].strip("ap-"))
-                epgs.append(dn.split("/")[6].strip("epg-").strip("]"))
-
-        # Find L3outs, save to list
-        for fvRsBDToOut in get_gateway.iter("fvRsBDToOut"):
-            dn = fvRsBDToOut.get("dn")
-            if dn.rfind(bridge_domain) != -1:
-                l3Outs.append(dn.split("/")[3].strip("rsBDToOut-"))
-
-        # Find L3outs, save to list
-        for ipLearning in get_gateway.iter("ipLearning"):
-            iplearn = ipLearning.get("ipLearning")
-
-
-    except AttributeError:
-        pass
-
-    # Set variables from conditions
-    if aps:
-        join_aps = ', '.join(aps)
-    else:
-        join_aps = None
+    return MappingProxyType({key: tuple(value) if isinstance(value, list) else value for key, value in record.items()})
 
-    if epgs:
-        join_epgs = ', '.join(epgs)
-    else:
-        join_epgs = None
 
-    if l3Outs:
-        join_l3outs = ', '.join(l3Outs)
+def build_subnet_snapshot(session, apic, version=1) -> SubnetSnapshot:
+    """Pulls the BD subtree once into BD records and indexes every subnet by VRF for longest prefix matching"""
+
+    bds = get_bd_records(session, apic)
+
+    tries = collections.defaultdict(dict)
+    for bd in bds.values():
+        for fvSubnet in bd["subnets"]:
+            network = subnet_network(fvSubnet.get("ip"))
+            if network is None:
+                continue
+            trie = tries[bd["vrf_dn"]].setdefault(network.version, PrefixTrie(network.max_prefixlen))
+            trie.insert(network, fvSubnet)
+
+    return SubnetSnapshot(apic=apic, version=version, taken_at=time.time(),
+                          bds=MappingProxyType({dn: freeze_record(bd) for dn, bd in bds.items()}),
+                          tries=MappingProxyType({vrf: MappingProxyType(by_version) for vrf, by_version in tries.items()}),
+                          **gateway_catalog(bds))
+
+
+def gateway_catalog(bds) -> dict:
+    """Every gateway with its BD, tenant, VRF and scope, sorted by gateway text"""
+
+    catalog = sorted(({"gateway": fvSubnet.get("ip", "").lower(), "bd": bd["name"], "tenant": bd["tenant"],
+                       "vrf": bd["vrf"], "scope": fvSubnet.get("scope")}
+                      for bd in bds.values() for fvSubnet in bd["subnets"]), key=lambda entry: entry["gateway"])
+
+    return {"gateways": tuple(entry["gateway"] for entry in catalog),
+            "catalog": tuple(MappingProxyType(entry) for entry in catalog)}
+
+
+def start_snapshots(apic, get_session, max_age=SNAPSHOT_MAX_AGE) -> SnapshotRefresher:
+    """Starts background subnet snapshot refresh for an APIC, each rebuild asks get_session() for the current session"""
+
+    refresher = refreshers.get(apic)
+
+    if refresher is None:
+        refresher = SnapshotRefresher(f"subnets-{apic}",
+                                      lambda version: build_subnet_snapshot(get_session(), apic, version), max_age)
+        refreshers[apic] = refresher
     else:
-        join_l3outs = None
+        refresher.max_age = max_age
+        refresher.refresh()
+
+    refresher.start()
+
+    return refresher
+
+
+def stop_snapshots(apic) -> None:
+    """Stops and drops the subnet snapshot refresher of an APIC, e.g. once logged in to another one"""
+
+    refresher = refreshers.pop(apic, None)
+    if refresher is not None:
+        refresher.stop()
+
+
+def subnet_snapshot(session, apic) -> SubnetSnapshot:
+    """Returns the current subnet snapshot for the APIC, building one inline if no refresher is running or it has none
+    yet"""
+
+    refresher = refreshers.get(apic)
+    if refresher is None:
+        return build_subnet_snapshot(session, apic)
+
+    return refresher.current(timeout=SNAPSHOT_WAIT) or build_subnet_snapshot(session, apic)
+
+
+def subnet_changed(apic, event) -> None:
+    """Subscription feed listener for fvSubnet, a changed subnet asks for a snapshot rebuild"""
+
+    refresher = refreshers.get(apic)
+    if refresher is not None:
+        refresher.refresh()
+
+
+def search_gateways(session, apic, prefix="", offset=0, limit=25) -> dict:
+    """A page of the gateway catalog filtered by typed prefix, for the subnet finder typeahead"""
 
-    if not bd_vrf:
-        bd_vrf = None
+    total, page = subnet_snapshot(session, apic).search_gateways(prefix, offset, limit)
+
+    return {"total": total, "offset": offset, "gateways": [dict(entry) for entry in page]}
+
+
+def subnet_entries(snapshot):
+    """Yields (vrf DN, network, entry) for every BD subnet in a snapshot"""
+
+    for bd in snapshot.bds.values():
+        for fvSubnet in bd["subnets"]:
+            network = subnet_network(fvSubnet.get("ip"))
+            if network is not None:
+                yield bd["vrf_dn"], network, {"subnet": fvSubnet.get("ip"), "bd": bd["name"], "tenant": bd["tenant"],
+                                              "vrf": bd["vrf"], "scope": fvSubnet.get("scope")}
+
+
+def overlap_report(snapshot) -> dict:
+    """Finds subnets that overlap or duplicate another in the same VRF with a sorted sweep per VRF, and networks
+    configured in more than one VRF"""
+
+    by_vrf = collections.defaultdict(list)
+    by_network = collections.defaultdict(list)
+    for vrf, network, entry in subnet_entries(snapshot):
+        by_vrf[vrf].append((network.version, int(network.network_address), int(network.broadcast_address), entry))
+        by_network[network].append((vrf, entry))
+
+    # Sorted by start, widest first. Identical ranges sort next to each other, anything else is checked against the
+    # furthest reaching subnet before it
+    overlaps = []
+    for vrf, ranges in by_vrf.items():
+        ranges.sort(key=lambda item: (item[0], item[1], -item[2]))
+        previous = reach = None
+        for item in ranges:
+            version, start, end, entry = item
+            if previous is not None and previous[:3] == item[:3]:
+                overlaps.append({"vrf_dn": vrf, "type": "duplicate", **entry, "overlaps": previous[3]["subnet"],
+                                 "overlaps_bd": previous[3]["bd"]})
+            elif reach is not None and reach[0] == version and start <= reach[2]:
+                overlaps.append({"vrf_dn": vrf, "type": "overlap", **entry, "overlaps": reach[3]["subnet"],
+                                 "overlaps_bd": reach[3]["bd"]})
+            if reach is None or reach[0] != version or end > reach[2]:
+                reach = item
+            previous = item
+
+    cross_vrf = []
+    for network, entries in by_network.items():
+        vrfs = sorted({vrf or "" for vrf, _ in entries})
+        if len(vrfs) > 1:
+            cross_vrf.append({"network": str(network), "vrfs": vrfs, "entries": [entry for _, entry in entries],
+                              "shared": any("shared" in (entry["scope"] or "") for _, entry in entries)})
+
+    return {"vrfs": len(by_vrf), "subnets": sum(len(ranges) for ranges in by_vrf.values()),
+            "overlaps": overlaps, "cross_vrf_duplicates": sorted(cross_vrf, key=lambda item: item["network"])}
+
+
+def subnet_overlaps(session, apic) -> dict:
+
+    return overlap_report(subnet_snapshot(session, apic))
+
+
+def join_or_none(values):
+
+    return ', '.join(values) if values else None
+
+
+def find_gateways(unicast_gateway, session, apic) -> list:
+    """Search for ACI Gateways and get configurations. The subnet is found by longest prefix match in every VRF, the
+    same range can live in more than one, and everything else comes from its BD record. Returns one tuple per VRF
+    with a match, longest prefix first, and an empty list when nothing matches"""
 
     if not unicast_gateway:
-        bridge_domain = 0
+        return []
 
-    # Return to user input
-    return bridge_domain, uni_route, scope, unkwn_uni, tenant, join_aps, join_epgs, join_l3outs, bd_vrf, iplearn, mtu, learn_limit, mac, gateways
+    snapshot = subnet_snapshot(session, apic)
 
+    try:
+        matches = snapshot.find_subnet(unicast_gateway)
+    except ValueError:
+        return []
+
+    gateways = []
+    for vrf_dn, _, fvSubnet in matches:
+        bd = snapshot.bds[parent_dn(fvSubnet["dn"], "/subnet-[")]
+        gateways.append((bd["name"], bd["unicastRoute"], fvSubnet.get("scope"), bd["unkMacUcastAct"], bd["tenant"],
+                         join_or_none(bd["aps"]), join_or_none(bd["epgs"]), join_or_none(bd["l3outs"]), bd["vrf"],
+                         bd["ipLearning"], bd["mtu"], bd["limitIpLearnToSubnets"], bd["mac"], fvSubnet.get("ip"), vrf_dn))
+
+    # Return to user input
+    return gateways
@@ -0,0 +1,186 @@
+"""Receives APIC change events over its websocket and hands them to the caches that depend on them"""
+
+import json
+import ssl
+import threading
+import traceback
+import websocket
+
+# Classes subscribed on every APIC, each has a cache listening to it. Encap attachments (fvRsPathAtt) are queried live
+# on every lookup, so they aren't subscribed
+SUBSCRIBED_CLASSES = ("fvCEp", "fvIp", "fvSubnet", "fvnsEncapBlk")
+
+# APIC drops a subscription that isn't refreshed within 90 seconds, renew well inside that
+REFRESH_INTERVAL = 45
+
+# Seconds to wait before reconnecting a closed websocket
+RETRY_INTERVAL = 15
+
+# Subscription feeds, keyed by APIC
+feeds = {}
+
+
+def parse_events(message) -> list:
+    """Turns a websocket message into one event dict per changed object"""
+
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return []
+
+    events = []
+    for mo in data.get("imdata", []):
+        for class_name, body in mo.items():
+            attributes = body.get("attributes", {})
+            events.append({"class": class_name, "status": attributes.get("status", "modified"),
+                           "dn": attributes.get("dn"), "attributes": attributes})
+
+    return events
+
+
+class SubscriptionFeed:
+
+    """One websocket per APIC. Subscribes to SUBSCRIBED_CLASSES whenever the socket opens, renews the subscriptions
+    until it closes and calls every listener of an event's class with the APIC and the event. After a reconnect,
+    listeners get a "resync" event for their class since changes may have been missed while the socket was down"""
+
+    def __init__(self, apic, get_session, base_url=None):
+
+        self.apic = apic
+        self.get_session = get_session
+        self.base_url = base_url or f"https://{apic}"
+        self.connected = False
+        self.listeners = {class_name: set() for class_name in SUBSCRIBED_CLASSES}
+        self._subscriptions = {}
+        self._opened_before = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+        self._refresher = None
+
+    def listen(self, class_name, callback) -> None:
+        """Adds callback(apic, event) for a subscribed class, adding the same callback twice has no effect"""
+
+        self.listeners[class_name].add(callback)
+
+    def socket_url(self) -> str:
+
+        token = self.get_session().cookies.get("APIC-cookie", "")
+
+        return f"{self.base_url.replace('http', 'ws', 1)}/socket{token}"
+
+    def start(self) -> None:
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"feed-{self.apic}", daemon=True)
+            self._thread.start()
+            self._refresher = threading.Thread(target=self._renew, name=f"feed-renew-{self.apic}", daemon=True)
+            self._refresher.start()
+
+    def stop(self) -> None:
+
+        self._stop.set()
+        if self._socket is not None:
+            self._socket.close()
+
+    def subscribe(self, class_name) -> None:
+        """Subscribes a class on the open websocket, ids are kept so the renew thread can refresh them. The subscribe
+        query asks for a single object, events still cover the whole class but the response doesn't carry all of it"""
+
+        response = self.get_session().get(f"{self.base_url}/api/class/{class_name}.json?subscription=yes&page-size=1",
+                                          verify=False)
+        subscription_id = response.json()["subscriptionId"]
+
+        with self._lock:
+            self._subscriptions[subscription_id] = class_name
+
+    def renew(self) -> None:
+        """Refreshes every subscription, one the APIC no longer knows is taken out again"""
+
+        with self._lock:
+            subscriptions = dict(self._subscriptions)
+
+        for subscription_id, class_name in subscriptions.items():
+            response = self.get_session().get(f"{self.base_url}/api/subscriptionRefresh.json?id={subscription_id}",
+                                              verify=False)
+            if response.status_code != 200:
+                with self._lock:
+                    self._subscriptions.pop(subscription_id, None)
+                self.subscribe(class_name)
+
+    def dispatch(self, event) -> None:
+
+        for callback in list(self.listeners.get(event["class"], ())):
+            try:
+                callback(self.apic, event)
+            except Exception:
+                traceback.print_exc()
+
+    def _on_open(self, socket) -> None:
+
+        with self._lock:
+            self._subscriptions.clear()
+
+        for class_name in SUBSCRIBED_CLASSES:
+            self.subscribe(class_name)
+
+        self.connected = True
+        if self._opened_before:
+            for class_name in SUBSCRIBED_CLASSES:
+                self.dispatch({"class": class_name, "status": "resync", "dn": None, "attributes": {}})
+        self._opened_before = True
+
+    def _on_message(self, socket, message) -> None:
+
+        for event in parse_events(message):
+            self.dispatch(event)
+
+    def _on_error(self, socket, error) -> None:
+
+        print(f"Subscription feed {self.apic}: {error}")
+
+    def _on_close(self, socket, status, message) -> None:
+
+        self.connected = False
+
+    def _run(self) -> None:
+
+        while not self._stop.is_set():
+            self._socket = websocket.WebSocketApp(self.socket_url(), on_open=self._on_open,
+                                                  on_message=self._on_message, on_error=self._on_error,
+                                                  on_close=self._on_close)
+            self._socket.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE}, ping_interval=30)
+            self.connected = False
+            self._stop.wait(RETRY_INTERVAL)
+
+    def _renew(self) -> None:
+
+        while not self._stop.wait(REFRESH_INTERVAL):
+            if not self.connected:
+                continue
+            try:
+                self.renew()
+            except Exception:
+                traceback.print_exc()
+
+
+def start_feed(apic, get_session, base_url=None) -> SubscriptionFeed:
+    """Starts the subscription feed of an APIC, get_session() gives the current session whenever the feed needs one"""
+
+    if apic not in feeds:
+        feeds[apic] = SubscriptionFeed(apic, get_session, base_url)
+
+    feed = feeds[apic]
+    feed.start()
+
+    return feed
+
+
+def stop_feed(apic) -> None:
+    """Closes and drops the subscription feed of an APIC, e.g. once logged in to another one"""
+
+    feed = feeds.pop(apic, None)
+    if feed is not None:
+        feed.stop()
@@ -0,0 +1,92 @@
+"""Fabric wide vlan utilization computed as NumPy matrices"""
+
+import numpy as np
+import app.Modules.ACI_Policies as GetPolicies
+from app.Modules.ApicQuery import run_alongside, ApicError
+
+VLAN_SLOTS = GetPolicies.VLAN_SLOTS
+
+
+def pool_matrix(snapshot) -> tuple:
+    """Returns pool names and a pool x vlan boolean matrix, True where the pool contains the vlan"""
+
+    pools = sorted(snapshot.vlan_pools)
+    matrix = np.zeros((len(pools), VLAN_SLOTS), dtype=bool)
+
+    for row, pool in enumerate(pools):
+        for begin_range, end_range in snapshot.vlan_pools[pool].ranges:
+            matrix[row, begin_range:end_range + 1] = True
+
+    return pools, matrix
+
+
+def attachment_matrix(epg_vlans, l3out_index) -> np.ndarray:
+    """Returns a 2 x vlan matrix of attachment counts, row 0 EPG path attachments, row 1 L3Out attachments. L3Out
+    keys that aren't vlan ids, routed interfaces ("unknown") and vxlan encaps, are left out"""
+
+    l3out_vlans = {int(vlan): len(dns) for vlan, dns in l3out_index.items() if vlan.isdigit()}
+    l3_vlans = np.repeat(np.fromiter(l3out_vlans.keys(), dtype=np.int64, count=len(l3out_vlans)),
+                         np.fromiter(l3out_vlans.values(), dtype=np.int64, count=len(l3out_vlans)))
+    epg_vlans = np.asarray(epg_vlans, dtype=np.int64)
+
+    return np.vstack([np.bincount(epg_vlans[epg_vlans < VLAN_SLOTS], minlength=VLAN_SLOTS),
+                      np.bincount(l3_vlans[l3_vlans < VLAN_SLOTS], minlength=VLAN_SLOTS)])
+
+
+def free_blocks(matrix) -> list:
+    """Finds runs of True per row, returns a list of (begin, end) ranges for each row"""
+
+    padded = np.zeros((matrix.shape[0], matrix.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = matrix
+    edges = np.diff(padded, axis=1)
+
+    # Rows come back in order from nonzero, so starts and ends pair up row by row
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+
+    blocks = [[] for _ in range(matrix.shape[0])]
+    for row, begin_range, end_range in zip(start_rows.tolist(), starts.tolist(), (ends - 1).tolist()):
+        blocks[row].append((begin_range, end_range))
+
+    return blocks
+
+
+def utilization_report(snapshot, epg_vlans, l3out_index) -> dict:
+    """Builds the whole fabric report, per pool usage with free blocks and per vlan pools and attachment counts"""
+
+    pools, pools_by_vlan = pool_matrix(snapshot)
+    attachments = attachment_matrix(epg_vlans, l3out_index)
+
+    in_use = attachments.sum(axis=0) > 0
+    free = pools_by_vlan & ~in_use
+    pool_size = pools_by_vlan.sum(axis=1)
+    pool_used = (pools_by_vlan & in_use).sum(axis=1)
+
+    pool_rows = []
+    for row, (pool, blocks) in enumerate(zip(pools, free_blocks(free))):
+        pool_rows.append({'pool': pool, 'size': int(pool_size[row]), 'used': int(pool_used[row]),
+                          'free': int(pool_size[row] - pool_used[row]),
+                          'free_blocks': [f"{begin}-{end}" if begin != end else f"{begin}" for begin, end in blocks]})
+
+    vlan_rows = []
+    for vlan in np.flatnonzero(pools_by_vlan.any(axis=0) | in_use).tolist():
+        vlan_rows.append({'vlan': vlan, 'pools': [pools[row] for row in np.flatnonzero(pools_by_vlan[:, vlan])],
+                          'epg_attachments': int(attachments[0, vlan]), 'l3out_attachments': int(attachments[1, vlan])})
+
+    return {'apic': snapshot.apic, 'version': snapshot.version, 'pools': pool_rows, 'vlans': vlan_rows,
+            'unpooled_in_use': np.flatnonzero(in_use & ~pools_by_vlan.any(axis=0)).tolist()}
+
+
+def vlan_report(session, apic) -> dict:
+    """Fetches EPG attachments alongside the current policy snapshot and builds the utilization report. Raises
+    ApicError if the L3Out attachments can't be read, rather than reporting their vlans as unused"""
+
+    # The snapshot may wait on its refresher, which queries through the pool, so it's read in this thread
+    snapshot, epg_vlans = run_alongside((GetPolicies.policy_snapshot, session, apic),
+                                        (GetPolicies.request_attachment_encaps, session, apic))
+
+    l3out_index = GetPolicies.get_l3out_index(session, apic, snapshot)
+    if l3out_index is None:
+        raise ApicError(f"{apic}: L3Out attachments couldn't be read")
+
+    return utilization_report(snapshot, epg_vlans, l3out_index)
@@ -0,0 +1,53 @@
+"""Runs login preload stages in the background and reports their progress"""
+
+import threading
+import time
+import traceback
+
+
+class Warmup:
+
+    """Starts every stage on its own thread right after login, status() reports progress for the UI. Stages only warm
+    the caches their pages read, so their results aren't kept"""
+
+    def __init__(self, apic, stages):
+
+        self.apic = apic
+        self.stages = stages
+        self.started = None
+        self._lock = threading.Lock()
+        self._state = {name: {"state": "pending", "seconds": None, "error": None} for name in stages}
+
+    def start(self) -> None:
+
+        self.started = time.monotonic()
+        for name in self.stages:
+            threading.Thread(target=self._run, args=(name,), name=f"warmup-{name}", daemon=True).start()
+
+    def _run(self, name) -> None:
+
+        begin = time.monotonic()
+        with self._lock:
+            self._state[name]["state"] = "running"
+
+        try:
+            self.stages[name]()
+        except Exception as error:
+            traceback.print_exc()
+            with self._lock:
+                self._state[name].update(state="failed", seconds=round(time.monotonic() - begin, 2),
+                                         error=str(error))
+            return
+
+        with self._lock:
+            self._state[name].update(state="done", seconds=round(time.monotonic() - begin, 2))
+
+    def status(self) -> dict:
+
+        with self._lock:
+            stages = {name: dict(state) for name, state in self._state.items()}
+
+        finished = sum(1 for state in stages.values() if state["state"] in ("done", "failed"))
+
+        return {"apic": self.apic, "stages": stages, "finished": finished, "total": len(stages),
+                "complete": finished == len(stages)}
@@ -1,7 +1,7 @@
 # -*- encoding: utf-8 -*-
 
 from flask_login import UserMixin
-from sqlalchemy import Binary, Column, Integer, String
+from sqlalchemy import Binary, Column, DateTime, Index, Integer, String
 
 from app import db, login_manager
 
@@ -34,6 +34,35 @@ class User(db.Model, UserMixin):
         return str(self.username)
 
 
+class EndpointLocation(db.Model):
+    """One row per leaf and ip each time an endpoint's location changes, a missing leaf or ip is a row with none"""
+
+    __tablename__ = 'EndpointLocation'
+    __table_args__ = (
+        Index('ix_EndpointLocation_mac', 'apic', 'mac', 'seen_at'),
+        Index('ix_EndpointLocation_ip', 'apic', 'ip', 'seen_at'),
+        Index('ix_EndpointLocation_leaf', 'apic', 'leaf', 'seen_at'),
+        Index('ix_EndpointLocation_dn', 'apic', 'dn', 'seen_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    apic = Column(String, nullable=False)
+    dn = Column(String, nullable=False)
+    mac = Column(String)
+    ip = Column(String)
+    tenant = Column(String)
+    ap = Column(String)
+    epg = Column(String)
+    encap = Column(String)
+    leaf = Column(String)
+    paths = Column(String)
+    seen_at = Column(DateTime, nullable=False)
+
+    def to_dict(self):
+        return {'dn': self.dn, 'mac': self.mac, 'ip': self.ip, 'tenant': self.tenant, 'ap': self.ap, 'epg': self.epg,
+                'encap': self.encap, 'leaf': self.leaf, 'paths': self.paths, 'seen_at': self.seen_at.isoformat()}
+
+
 @login_manager.user_loader
 def user_loader(id):
     return User.query.filter_by(id=id).first()
@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 
-from flask import render_template, redirect, request, url_for, jsonify, flash
+from flask import render_template, redirect, request, url_for, jsonify, flash, Response, current_app, \
+    stream_with_context
 from flask_login import (
     current_user,
     login_required,
@@ -15,15 +16,28 @@ from app.base.util import verify_pass
 import app.Modules.ACI_Policies as GetPolicies
 import app.Modules.FindEncap as FindEncap
 import app.Modules.EndpointTracker as EpTracker
+import app.Modules.EndpointIndex as EpIndex
+import app.Modules.BulkEndpoints as BulkEndpoints
+import app.Modules.EndpointHistory as EpHistory
+import app.Modules.FlapDetector as FlapDetector
 import app.Modules.SubnetFinder as GetGateway
-import app.Modules.ACIOps as AciOps
-from app.Modules.GeneralFunctions import session_time
-import ipaddress
+import app.Modules.InfraMonitor as InfraMonitor
+import app.Modules.VlanReport as VlanReport
+import app.Modules.SubscriptionFeed as SubscriptionFeed
+from app.Modules.GeneralFunctions import session_time, current_session
+from app.Modules.ApicQuery import ApicError
+from app.Modules.Warmup import Warmup
+import functools
+import io
+import itertools
+import datetime
+import json
 
 apic = None
 username = None
 password = None
 apic_session = None
+warmup = None
 
 
 @blueprint.route('/')
@@ -31,6 +45,79 @@ def route_default():
     return redirect(url_for('base_blueprint.login'))
 
 
+def start_warmup():
+    """Starts login preload stages in parallel on background threads, login doesn't wait for them"""
+
+    global warmup
+
+    # Background loaders read the session on every use, so they follow session_time's re-logins
+    get_session = functools.partial(current_session, apic)
+
+    refresher = GetPolicies.start_snapshots(apic, get_session, current_app.config['POLICY_SNAPSHOT_MAX_AGE'])
+    subnet_refresher = GetGateway.start_snapshots(apic, get_session, current_app.config['SUBNET_SNAPSHOT_MAX_AGE'])
+    infra_refresher = InfraMonitor.start_poller(apic, get_session, current_app.config['INFRA_SNAPSHOT_MAX_AGE'])
+    endpoint_refresher = EpIndex.start_index(apic, get_session, current_app.config['ENDPOINT_INDEX_INTERVAL'])
+    FlapDetector.start_detector(apic, current_app.config['FLAP_THRESHOLD'], current_app.config['FLAP_WINDOW'])
+    EpHistory.start_collector(current_app._get_current_object(), apic, current_app.config['ENDPOINT_HISTORY_INTERVAL'],
+                              current_app.config['ENDPOINT_HISTORY_DAYS'])
+    start_feed()
+
+    def load_policies():
+        snapshot = refresher.current(timeout=GetPolicies.SNAPSHOT_WAIT)
+        if snapshot is None:
+            raise RuntimeError("Policy snapshot not loaded")
+        return snapshot.version
+
+    def load_subnets():
+        snapshot = subnet_refresher.current(timeout=GetGateway.SNAPSHOT_WAIT)
+        if snapshot is None:
+            raise RuntimeError("Subnet snapshot not loaded")
+        return snapshot.version
+
+    def load_infra():
+        snapshot = infra_refresher.current(timeout=InfraMonitor.SNAPSHOT_WAIT)
+        if snapshot is None:
+            raise RuntimeError("Infra snapshot not loaded")
+        return snapshot.version
+
+    def load_endpoints():
+        index = endpoint_refresher.current(timeout=EpIndex.INDEX_WAIT)
+        if index is None:
+            raise RuntimeError("Endpoint index not loaded")
+        return len(index)
+
+    warmup = Warmup(apic, {'policies': load_policies,
+                           'endpoints': load_endpoints,
+                           'subnets': load_subnets,
+                           'infra': load_infra})
+    warmup.start()
+
+
+def start_feed():
+    """Starts the APIC websocket feed and points its change events at the caches they affect"""
+
+    if not current_app.config['APIC_SUBSCRIPTIONS']:
+        return
+
+    feed = SubscriptionFeed.start_feed(apic, functools.partial(current_session, apic),
+                                       current_app.config['APIC_FEED_URL'] or None)
+    feed.listen('fvCEp', EpIndex.endpoint_changed)
+    feed.listen('fvIp', EpIndex.endpoint_changed)
+    feed.listen('fvnsEncapBlk', GetPolicies.policy_changed)
+    feed.listen('fvSubnet', GetGateway.subnet_changed)
+
+
+def stop_background(old_apic):
+    """Stops the background loaders of an APIC that is no longer logged in to, its session can't be renewed"""
+
+    GetPolicies.stop_snapshots(old_apic)
+    GetGateway.stop_snapshots(old_apic)
+    InfraMonitor.stop_poller(old_apic)
+    EpIndex.stop_index(old_apic)
+    EpHistory.stop_collector(old_apic)
+    SubscriptionFeed.stop_feed(old_apic)
+
+
 @blueprint.route('/login', methods=['GET', 'POST'])
 def login():
     global apic, username, password, apic_session
@@ -38,6 +125,7 @@ def login():
     login_form = LoginForm(request.form)
     if 'login' in request.form:
 
+        previous_apic = apic
         apic = request.form['apic']
         username = request.form['username']
         password = request.form['password']
@@ -49,8 +137,9 @@ def login():
 
             if apic_session is not None:
 
-                GetPolicies.vlan_pools(apic_session, apic)
-                GetPolicies.domains(apic_session, apic)
+                if previous_apic is not None and previous_apic != apic:
+                    stop_background(previous_apic)
+                start_warmup()
                 session_time(username, password, apic)
                 return redirect(url_for('base_blueprint.find_encap'))
             else:
@@ -62,6 +151,16 @@ def login():
     return redirect(url_for('home_blueprint.index'))
 
 
+@blueprint.route('/warmup_status')
+def warmup_status():
+    """Reports progress of the login preload"""
+
+    if warmup is None:
+        return jsonify({'apic': apic, 'stages': {}, 'finished': 0, 'total': 0, 'complete': True})
+
+    return jsonify(warmup.status())
+
+
 @blueprint.route('/logout')
 def logout():
     """User logout"""
@@ -99,6 +198,60 @@ def submit_encap():
     return jsonify({'data': render_template('map_policies.html', object_list=get_policies)})
 
 
+@blueprint.route('/submit_encap_bulk')
+def find_encap_bulk():
+    """Bulk encap finder home page"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return render_template('submit_encap_bulk.html')
+
+
+@blueprint.route('/submit_encap_bulk', methods=['POST'])
+def submit_encap_bulk():
+    """Find a list or range of encaps, streams one json line per vlan. Accepts form data or a json body"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    payload = request.get_json(silent=True) or request.form
+
+    try:
+        vlans = GetPolicies.parse_vlan_list(payload.get("encaps", ""))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    # The page reads the error from json, the 503 handler would answer this route with html
+    try:
+        results = GetPolicies.bulk_policy_configurations(apic_session, apic, vlans)
+    except ApicError as error:
+        return jsonify({'error': str(error)}), 503
+
+    return Response((json.dumps(result) + "\n" for result in results), mimetype='application/x-ndjson')
+
+
+@blueprint.route('/vlan_report')
+def view_vlan_report():
+    """Fabric wide vlan utilization page"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+    get_report = VlanReport.vlan_report(apic_session, apic)
+
+    return render_template('vlan_report.html', report=get_report)
+
+
+@blueprint.route('/api/vlan_report')
+def api_vlan_report():
+    """Fabric wide vlan utilization as json"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return jsonify(VlanReport.vlan_report(apic_session, apic))
+
+
 @blueprint.route('/submit_endpoint')
 def find_endpoint():
     """Finds endpoint homepage"""
@@ -111,23 +264,157 @@ def find_endpoint():
 
 @blueprint.route('/submit_endpoint', methods=['POST'])
 def submit_endpoint():
-    """Find users endpoint query"""
+    """Find users endpoint query, a prefix such as 10.20.0.0/16 lists every endpoint inside it"""
 
     #Check current session for experation
     session_time(username, password, apic)
 
+    if "/" in request.form.get("endpoint", ""):
+        result, error = endpoint_prefix_search(request.form["endpoint"])
+        return jsonify({'data': render_template('map_endpoint_prefix.html', result=result, error=error)})
+
+    get_endpoint, get_reverse, logs = EpTracker.lookup_endpoint(request.form.get("endpoint"), apic_session, apic,
+                                                              index=EpIndex.get_index(apic))
+
+    return jsonify({'data': render_template('map_endpoint.html', object_list=get_endpoint, reverse=get_reverse, logs=logs)})
+
+
+def endpoint_prefix_search(prefix, limit=EpIndex.MAX_PREFIX_RESULTS):
+    """Prefix search on the endpoint index, returns the result and an error message"""
+
+    index = EpIndex.get_index(apic)
+    if index is None:
+        return None, 'Endpoint index is still loading, try again shortly'
+
     try:
-        ipaddress.IPv4Address(request.form.get("endpoint"))
-        get_endpoint = EpTracker.find_ip_endpoints(request.form.get("endpoint"), apic_session, apic)
-        get_reverse = EpTracker.find_mac_endpoints(get_endpoint[0], apic_session, apic)
+        return EpIndex.prefix_search(index, prefix, limit), None
+    except ValueError:
+        return None, f'{prefix} is not an IPv4 prefix'
+
+
+@blueprint.route('/api/endpoints/prefix')
+def api_endpoint_prefix():
+    """Every endpoint learned inside ?prefix=10.20.0.0/16 as json, up to ?limit addresses"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
 
-        return jsonify({'data': render_template('map_endpoint.html', object_list=get_endpoint, reverse=get_reverse, logs=get_reverse[8])})
+    result, error = endpoint_prefix_search(request.args.get("prefix", ""),
+                                           request.args.get("limit", EpIndex.MAX_PREFIX_RESULTS, type=int))
+    if error:
+        return jsonify({'error': error}), 503 if EpIndex.get_index(apic) is None else 400
 
-    except ipaddress.AddressValueError:
-        get_endpoint = EpTracker.find_mac_endpoints(request.form.get("endpoint"), apic_session, apic)
-        get_reverse = EpTracker.find_ip_endpoints(get_endpoint[0], apic_session, apic)
+    return jsonify(result)
 
-        return jsonify({'data': render_template('map_endpoint.html', object_list=get_endpoint, reverse=get_reverse, logs=get_endpoint[8])})
+
+@blueprint.route('/flappers')
+def view_flappers():
+    """Live top flapping endpoints page"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return render_template('flappers.html', threshold=current_app.config['FLAP_THRESHOLD'],
+                           window=current_app.config['FLAP_WINDOW'])
+
+
+@blueprint.route('/api/flappers')
+def api_flappers():
+    """Endpoints moving more than FLAP_THRESHOLD times in FLAP_WINDOW seconds, most moves first"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    detector = FlapDetector.detectors.get(apic)
+    flappers = detector.top(request.args.get("limit", 50, type=int)) if detector else []
+
+    return jsonify({'apic': apic, 'flappers': flappers})
+
+
+@blueprint.route('/submit_endpoint_bulk')
+def find_endpoint_bulk():
+    """Bulk endpoint finder home page"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return render_template('submit_endpoint_bulk.html')
+
+
+@blueprint.route('/submit_endpoint_bulk', methods=['POST'])
+def submit_endpoint_bulk():
+    """Find an uploaded CSV or newline list of MACs/IPs, streams one json line per endpoint, or CSV rows when format
+    is csv. Accepts form data, a file upload or a json body"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    payload = request.get_json(silent=True) or request.form
+    upload = request.files.get("file")
+
+    if upload and upload.filename:
+        lines = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", errors="replace")
+    elif isinstance(payload.get("endpoints"), list):
+        lines = payload["endpoints"]
+    else:
+        lines = io.StringIO(payload.get("endpoints", ""))
+
+    values = BulkEndpoints.iter_endpoint_values(lines)
+    first = next(values, None)
+    if first is None:
+        return jsonify({'error': 'No MACs or IPs given'}), 400
+
+    # Jobs can outlast a login, each lookup reads the current session
+    results = BulkEndpoints.bulk_endpoints(itertools.chain([first], values), functools.partial(current_session, apic),
+                                           apic, index=EpIndex.get_index(apic),
+                                           rate=current_app.config['BULK_ENDPOINT_RATE'])
+
+    if payload.get("format") == "csv":
+        return Response(stream_with_context(BulkEndpoints.csv_rows(results)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=endpoints.csv'})
+
+    return Response(stream_with_context(json.dumps(result) + "\n" for result in results),
+                    mimetype='application/x-ndjson')
+
+
+@blueprint.route('/api/endpoint_history/location')
+def api_endpoint_location():
+    """Where a MAC/IP was at a time (ISO 8601, UTC), from the local endpoint history. Defaults to now"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    try:
+        when = EpHistory.parse_time(request.args.get("at"), EpHistory.utc_now())
+    except ValueError:
+        return jsonify({'error': 'at must be an ISO 8601 time'}), 400
+
+    endpoint = request.args.get("endpoint")
+    if not endpoint:
+        return jsonify({'error': 'endpoint is required'}), 400
+
+    return jsonify({'endpoint': endpoint, 'at': when.isoformat(),
+                    'locations': EpHistory.location_at(apic, endpoint, when)})
+
+
+@blueprint.route('/api/endpoint_history/moves')
+def api_endpoint_moves():
+    """Endpoint moves from the local endpoint history, filtered by leaf and/or MAC/IP. The window is since/until
+    (ISO 8601, UTC) or the last minutes, an hour by default"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    try:
+        until = EpHistory.parse_time(request.args.get("until"), EpHistory.utc_now())
+        since = EpHistory.parse_time(request.args.get("since"),
+                                     until - datetime.timedelta(minutes=request.args.get("minutes", 60, type=int)))
+    except ValueError:
+        return jsonify({'error': 'since and until must be ISO 8601 times'}), 400
+
+    moves = EpHistory.moves(apic, since, until, leaf=request.args.get("leaf"), endpoint=request.args.get("endpoint"))
+
+    return jsonify({'since': since.isoformat(), 'until': until.isoformat(), 'moves': moves})
 
 
 @blueprint.route('/submit_subnet')
@@ -136,9 +423,20 @@ def find_subnet():
 
     #Check current session for experation
     session_time(username, password, apic)
-    get_gateways = GetGateway.get_gateways(apic_session, apic)
 
-    return render_template('submit_subnet.html', gateways=get_gateways)
+    return render_template('submit_subnet.html')
+
+
+@blueprint.route('/api/gateways')
+def api_gateways():
+    """Gateway typeahead, ?q= filters by typed prefix, paged with ?offset= and ?limit="""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return jsonify(GetGateway.search_gateways(apic_session, apic, request.args.get("q", ""),
+                                              request.args.get("offset", 0, type=int),
+                                              request.args.get("limit", 25, type=int)))
 
 
 @blueprint.route('/submit_subnet', methods=['POST'])
@@ -149,7 +447,27 @@ def submit_subnet():
     session_time(username, password, apic)
     get_gateway = GetGateway.find_gateways(request.form.get("gateway"), apic_session, apic)
 
-    return jsonify({'data': render_template('map_subnet.html', object_list=get_gateway)})
+    return jsonify({'data': render_template('map_subnet.html', matches=get_gateway)})
+
+
+@blueprint.route('/subnet_overlaps')
+def view_subnet_overlaps():
+    """Overlapping and duplicate BD subnets page"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return render_template('subnet_overlaps.html', report=GetGateway.subnet_overlaps(apic_session, apic))
+
+
+@blueprint.route('/api/subnet_overlaps')
+def api_subnet_overlaps():
+    """Overlapping and duplicate BD subnets as json"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    return jsonify(GetGateway.subnet_overlaps(apic_session, apic))
 
 
 @blueprint.route('/infra')
@@ -158,9 +476,27 @@ def view_infra():
 
     #Check current session for experation
     session_time(username, password, apic)
-    get_infra_info = AciOps.infr(apic_session, apic)
+    snapshot = InfraMonitor.infra_snapshot(apic_session, apic)
+    hours = request.args.get("hours", InfraMonitor.TREND_HOURS, type=int)
+
+    return render_template('infra.html', fabric_infra=snapshot.infra, hours=hours,
+                           trends=InfraMonitor.health_trends(apic, hours),
+                           taken=datetime.datetime.fromtimestamp(snapshot.taken).strftime("%Y-%m-%d %H:%M:%S"))
 
-    return render_template('infra.html', fabric_infra=get_infra_info)
+
+@blueprint.route('/api/infra/health')
+def api_infra_health():
+    """Recorded health samples of a pod (podN) or node (podN/name), [epoch seconds, score] oldest first"""
+
+    #Check current session for experation
+    session_time(username, password, apic)
+
+    key = request.args.get("key", "")
+    if not key:
+        return jsonify({'error': 'key is required'}), 400
+
+    return jsonify({'key': key, 'samples': InfraMonitor.health_series(
+        apic, key, request.args.get("hours", InfraMonitor.TREND_HOURS, type=int))})
 
 
 @login_manager.unauthorized_handler
@@ -181,3 +517,13 @@ def not_found_error():
 @blueprint.errorhandler(500)
 def internal_error():
     return render_template('page-500.html'), 500
+
+
+@blueprint.errorhandler(ApicError)
+def apic_error(error):
+    """APIC answered with an error, e.g. an expired token, and there was no cached data to fall back on"""
+
+    if request.path.startswith('/api/'):
+        return jsonify({'error': str(error)}), 503
+
+    return render_template('page-500.html'), 503
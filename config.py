@@ -15,6 +15,35 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'db.sqlite3')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Oldest policy snapshot (vlan pools, domains, AAEPs) served to lookups, in seconds
+    POLICY_SNAPSHOT_MAX_AGE = config('POLICY_SNAPSHOT_MAX_AGE', default=300, cast=int)
+
+    # Oldest BD subnet snapshot served to gateway lookups, in seconds
+    SUBNET_SNAPSHOT_MAX_AGE = config('SUBNET_SNAPSHOT_MAX_AGE', default=300, cast=int)
+
+    # Oldest fabric inventory served to the infra page, in seconds. It's polled at half this, which also spaces the
+    # node and pod health samples
+    INFRA_SNAPSHOT_MAX_AGE = config('INFRA_SNAPSHOT_MAX_AGE', default=120, cast=int)
+
+    # Seconds between delta pulls of the local endpoint index
+    ENDPOINT_INDEX_INTERVAL = config('ENDPOINT_INDEX_INTERVAL', default=30, cast=int)
+
+    # Push APIC changes to the caches over the APIC websocket. APIC_FEED_URL points the feed somewhere other than
+    # the APIC itself, e.g. http://127.0.0.1:8765 for apic_standin.py
+    APIC_SUBSCRIPTIONS = config('APIC_SUBSCRIPTIONS', default=True, cast=bool)
+    APIC_FEED_URL = config('APIC_FEED_URL', default='')
+
+    # APIC queries per second made by bulk endpoint jobs, shared by every job against the same APIC
+    BULK_ENDPOINT_RATE = config('BULK_ENDPOINT_RATE', default=20, cast=int)
+
+    # Seconds between endpoint history passes, and days of history kept
+    ENDPOINT_HISTORY_INTERVAL = config('ENDPOINT_HISTORY_INTERVAL', default=30, cast=int)
+    ENDPOINT_HISTORY_DAYS = config('ENDPOINT_HISTORY_DAYS', default=30, cast=int)
+
+    # An endpoint moving more than FLAP_THRESHOLD times within FLAP_WINDOW seconds is reported as flapping
+    FLAP_THRESHOLD = config('FLAP_THRESHOLD', default=5, cast=int)
+    FLAP_WINDOW = config('FLAP_WINDOW', default=300, cast=int)
+
 
 class ProductionConfig(Config):
     DEBUG = False